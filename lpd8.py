@@ -1,404 +1,1304 @@
-from typing import List, Union, Tuple, Callable
+from typing import List, Dict, Union, Tuple, Callable
+import collections
+import concurrent.futures
+import heapq
+import queue
+import threading
 import time
+import traceback
+
+from lpd8stats import LPD8Instrumentation
+
+def programField(offset: int, name: str, maximum: int=127) -> property:
+    """Property reading/writing one byte of a pad/knob view"""
+    def getter(self) -> int:
+        return self.data[self.offset + offset]
+
+    def setter(self, value: int):
+        if not 0 <= value <= maximum:
+            raise Exception("%s out of range: %s (must be 0-%s)" % (name, value, maximum))
+        self.data[self.offset + offset] = value
+
+    return property(getter, setter)
 
 class LPD8Program():
     """LPD8 Program Abstraction
     Implements an LPD8 program which defines which notes and control change signals etc. each pad and knob is emitting.
-    The LPD8 can store 4 different programs which can be enabled from the device."""
+    The LPD8 can store 4 different programs which can be enabled from the device.
+    The program is stored as the sysex message that writes it, pads and knobs are views into that buffer."""
+    # Reference: https://github.com/charlesfleche/lpd8-editor/blob/d3c312e226f55ab0082b66e4732f5b860dc7b5fb/doc/SYSEX.md
+    writeHeader = bytes([0x47, 0x7F, 0x75, 0x61, 0x00, 0x3A])
+    replyHeader = bytes([0x47, 0x7F, 0x75, 0x63, 0x00, 0x3A])
+    length = 64         # Sysex length without start and stop bytes
+    padOffset = 8       # 8 pads with 4 bytes each
+    knobOffset = 40     # 8 knobs with 3 bytes each
+
     class Pad():
-        def __init__(self, note:int=0, programChange:int=0, controlChange:int=0, toggle:int=0):
-            self.note = note                    # type: int
-            self.programChange = programChange  # type: int
-            self.controlChange = controlChange  # type: int
-            self.toggle = toggle                # type: int
+        __slots__ = ("data", "offset")
+
+        note = programField(0, "Note")
+        programChange = programField(1, "Program change")
+        controlChange = programField(2, "Control change")
+        toggle = programField(3, "Toggle", 1)
+
+        def __init__(self, note:int=0, programChange:int=0, controlChange:int=0, toggle:int=0, data: bytearray=None, offset: int=0):
+            if data is None:    # Standalone pad
+                self.data = bytearray(4)    # type: bytearray
+                self.offset = 0             # type: int
+                self.note = note
+                self.programChange = programChange
+                self.controlChange = controlChange
+                self.toggle = int(toggle)
+            else:
+                self.data = data
+                self.offset = offset
 
         def __str__(self):
             return "LPD8 Pad; Note=%s; progChange=%s; cc=%s; toggle=%s" % (self.note, self.programChange, self.controlChange, self.toggle)
 
     class Knob():
-        def __init__(self, controlChange:int=0, low:int=0, high:int=0):
-            self.controlChange = controlChange  # type: int
-            self.low = low                      # type: int
-            self.high = high                    # type: int
+        __slots__ = ("data", "offset")
+
+        controlChange = programField(0, "Control change")
+        low = programField(1, "Low")
+        high = programField(2, "High")
+
+        def __init__(self, controlChange:int=0, low:int=0, high:int=0, data: bytearray=None, offset: int=0):
+            if data is None:    # Standalone knob
+                self.data = bytearray(3)    # type: bytearray
+                self.offset = 0             # type: int
+                self.controlChange = controlChange
+                self.low = low
+                self.high = high
+            else:
+                self.data = data
+                self.offset = offset
 
         def __str__(self):
             return "LPD8 Knob; cc=%s; low=%s; high=%s" % (self.controlChange, self.low, self.high)
 
     def __init__(self):
         self.programIndex = 0   # type: int
-        self.pads = []      # type: List[LPD8Program.Pad]
-        self.knobs = []     # type: List[LPD8Program.Knob]
-        for i in range(8):
-            self.pads.append(LPD8Program.Pad(note=i))
-            self.knobs.append(LPD8Program.Knob())
-
-    def readProgram(self, sysexData: List[int]):
+        self.data = bytearray(LPD8Program.length)
+        self.data[0:6] = LPD8Program.writeHeader
+        self.data[7] = 0x06     # Midi channel fixed to 6   # TODO: Make settable?
+        self.pads = tuple(LPD8Program.Pad(data=self.data, offset=LPD8Program.padOffset + 4*i) for i in range(8))       # type: Tuple[LPD8Program.Pad, ...]
+        self.knobs = tuple(LPD8Program.Knob(data=self.data, offset=LPD8Program.knobOffset + 3*i) for i in range(8))    # type: Tuple[LPD8Program.Knob, ...]
+        for i, pad in enumerate(self.pads):
+            pad.note = i
+
+    def readProgram(self, sysexData: Union[bytes, bytearray, memoryview, List[int], Tuple[int, ...]]):
         """Reads sysex program message from LPD8 device"""
-        # Reference: https://github.com/charlesfleche/lpd8-editor/blob/d3c312e226f55ab0082b66e4732f5b860dc7b5fb/doc/SYSEX.md
-        if not sysexData[0] == 0x47:
-            raise Exception("Manufacturerbyte (1) invalid: 0x%X (should be 0x47)" % sysexData[0])
-        if not sysexData[1:3] == [0x7F, 0x75]:
-            raise Exception("Modelbytes (2:3) invalid: 0x%X 0x%X (should be 0x7F 0x75)" % (sysexData[1], sysexData[2]))
-        if not sysexData[3:6] == [0x63, 0x00, 0x3A] and 1 <= sysexData[7] <= 4:
-            raise Exception("Commandbytes (3:6) invalid: 0x%X 0x%X 0x%X 0x%X (should be 0x63 0x00 0x3A 0x0X with X=[0..3])" % tuple(sysexData[3:6]))
-
-        self.programIndex = sysexData[6] - 1
-        self.pads = []  # type: List[LPD8Program.Pad]
-        self.knobs = []  # type: List[LPD8Program.Knob]
-        for i in range(8):
-            self.pads.append(LPD8Program.Pad(note=sysexData[8 + 4*i],
-                                             programChange=sysexData[9 + 4*i],
-                                             controlChange=sysexData[10 + 4*i],
-                                             toggle=sysexData[11 + 4*i]))
-            self.knobs.append(LPD8Program.Knob(controlChange=sysexData[40 + 3*i],
-                                               low=sysexData[41 + 3*i],
-                                               high=sysexData[42 + 3*i]))
-
-    def writeProgram(self) -> List[int]:
+        if not isinstance(sysexData, (bytes, bytearray, memoryview)):
+            sysexData = bytes(sysexData)
+        view = memoryview(sysexData)
+        if not view[0:6] == LPD8Program.replyHeader:
+            if not view[0] == 0x47:
+                raise Exception("Manufacturerbyte (1) invalid: 0x%X (should be 0x47)" % view[0])
+            if not view[1:3] == LPD8Program.replyHeader[1:3]:
+                raise Exception("Modelbytes (2:3) invalid: 0x%X 0x%X (should be 0x7F 0x75)" % (view[1], view[2]))
+            raise Exception("Commandbytes (3:6) invalid: 0x%X 0x%X 0x%X (should be 0x63 0x00 0x3A)" % tuple(view[3:6]))
+        if not len(view) >= LPD8Program.length:
+            raise Exception("Program data too short: %s bytes (must be %s)" % (len(view), LPD8Program.length))
+        if not 1 <= view[6] <= 4:
+            raise Exception("Program number invalid: %s (must be 1-4)" % view[6])
+
+        self.programIndex = view[6] - 1
+        self.data[8:] = view[8:LPD8Program.length]
+
+    def writeProgram(self) -> bytes:
         """Writes sysex program message for LPD8 device"""
-        # Reference: https://github.com/charlesfleche/lpd8-editor/blob/d3c312e226f55ab0082b66e4732f5b860dc7b5fb/doc/SYSEX.md
-        data = []
-        data += [0x47, 0x7F, 0x75, 0x61, 0x00, 0x3A]
-
         if not 0 <= self.programIndex <= 3:
             raise Exception("Program index out of range: %s (must be 0-3)" % self.programIndex)
-        data += [self.programIndex + 1]
-
-        data += [0x06]  # Midi channel fixed to 6   # TODO: Make settable?
-
-        if not len(self.pads) == 8:
-            raise Exception("Program has too few or too many pads: %s (must be 8)" % len(self.pads))
-        for pad in self.pads:
-            if not 0 <= pad.note <= 127:
-                raise Exception("Note for pad %s out of range: %s (must be 0-127)" % (self.pads.index(pad), pad.note))
-            if not 0 <= pad.programChange <= 127:
-                raise Exception("Program change for pad %s out of range: %s (must be 0-127)" % (self.pads.index(pad), pad.programChange))
-            if not 0 <= pad.controlChange <= 127:
-                raise Exception("Control change for pad %s out of range: %s (must be 0-127)" % (self.pads.index(pad), pad.controlChange))
-            if not 0 <= pad.toggle <= 1:
-                raise Exception("Toggle for pad %s out of range: %s (must be 0-1)" % (self.pads.index(pad), pad.oggle))
-            data += [pad.note, pad.programChange, pad.controlChange, pad.toggle]
-
-        if not len(self.knobs) == 8:
-            raise Exception("Program has too few or too many knobs: %s (must be 8)" % len(self.knobs))
-        for knob in self.knobs:
-            if not 0 <= knob.controlChange <= 127:
-                raise Exception("Control change for knob %s out of range: %s (must be 0-127)" % (self.knobs.index(knob), knob.controlChange))
-            if not 0 <= knob.low <= 127:
-                raise Exception("Control change for knob %s out of range: %s (must be 0-127)" % (self.knobs.index(knob), knob.low))
-            if not 0 <= knob.high <= 127:
-                raise Exception("Control change for knob %s out of range: %s (must be 0-127)" % (self.knobs.index(knob), knob.high))
-            data += [knob.controlChange, knob.low, knob.high]
-
-        return data
+        self.data[6] = self.programIndex + 1
+        return bytes(self.data)
+
+    def diff(self, other: "LPD8Program") -> List[Tuple[str, int, str, int, int]]:
+        """List of ("pad" or "knob", index, field, own value, other value) for every field that differs"""
+        changes = []
+        if self.data[8:] == other.data[8:]:
+            return changes
+        for i in range(8):
+            for field in ("note", "programChange", "controlChange", "toggle"):
+                if getattr(self.pads[i], field) != getattr(other.pads[i], field):
+                    changes.append(("pad", i, field, getattr(self.pads[i], field), getattr(other.pads[i], field)))
+            for field in ("controlChange", "low", "high"):
+                if getattr(self.knobs[i], field) != getattr(other.knobs[i], field):
+                    changes.append(("knob", i, field, getattr(self.knobs[i], field), getattr(other.knobs[i], field)))
+        return changes
+
+    def __eq__(self, other):
+        if not isinstance(other, LPD8Program):
+            return NotImplemented
+        return self.programIndex == other.programIndex and self.data[8:] == other.data[8:]
+
+    __hash__ = None
+
+class LPD8Event():
+    """A pad or knob event, carrying the same values a callback is called with"""
+    __slots__ = ("program", "pad", "knob", "value", "noteon", "noteoff", "cc", "pc", "device")
+
+    def __init__(self, program: int, pad: int, knob: int, value: int, noteon: int, noteoff: int, cc: int, pc: int, device: str=None):
+        self.program = program
+        self.pad = pad
+        self.knob = knob
+        self.value = value
+        self.noteon = noteon
+        self.noteoff = noteoff
+        self.cc = cc
+        self.pc = pc
+        self.device = device    # deviceId of the LPD8Device the event came from
+
+    def __str__(self):
+        return "LPD8 Event; device=%s; program=%s; pad=%s; knob=%s; value=%s; noteon=%s; noteoff=%s; cc=%s; pc=%s" % (
+            self.device, self.program, self.pad, self.knob, self.value, self.noteon, self.noteoff, self.cc, self.pc)
+
+class LPD8Allocator():
+    """Picks the value a colliding pad/knob field is moved to
+    owners holds what already uses each of the 128 values (None if the value is free).
+    previous is the value the preceding pad/knob of the same program ended up with (None for the first one)."""
+    def allocate(self, owners: List[object], value: int, previous: int) -> int:
+        for i in range(1, 128):     # Increase the value until it is free
+            candidate = (value + i) % 128
+            if owners[candidate] is None:
+                return candidate
+        raise Exception("No free value left for %s" % value)
+
+class LPD8ContiguousAllocator(LPD8Allocator):
+    """Continues right after the previous pad/knob of the same program, so values of a program stay contiguous"""
+    def allocate(self, owners: List[object], value: int, previous: int) -> int:
+        if previous is not None:
+            value = previous
+        return super(LPD8ContiguousAllocator, self).allocate(owners, value, None)
+
+class LPD8AmbiguityReport():
+    """Result of LPD8AmbiguitySolver.solve: the values that were changed and the conflicts that were found"""
+    class Change():
+        def __init__(self, program: int, pad: int, knob: int, field: str, old: int, new: int):
+            self.program = program
+            self.pad = pad
+            self.knob = knob
+            self.field = field
+            self.old = old
+            self.new = new
+
+        def __str__(self):
+            return "Program %s %s %s: %s %s -> %s" % (self.program, "pad" if self.pad is not None else "knob",
+                                                   self.pad if self.pad is not None else self.knob, self.field, self.old, self.new)
+
+    class Conflict():
+        def __init__(self, program: int, pad: int, knob: int, field: str, value: int, owner: Tuple[int, int, int]):
+            self.program = program
+            self.pad = pad
+            self.knob = knob
+            self.field = field
+            self.value = value
+            self.owner = owner  # (program, pad, knob) that already used the value
+
+        def __str__(self):
+            return "Program %s %s %s: %s %s already used by program %s %s %s" % (
+                self.program, "pad" if self.pad is not None else "knob", self.pad if self.pad is not None else self.knob,
+                self.field, self.value, self.owner[0], "pad" if self.owner[1] is not None else "knob",
+                self.owner[1] if self.owner[1] is not None else self.owner[2])
+
+    def __init__(self):
+        self.changes = []   # type: List[LPD8AmbiguityReport.Change]
+        self.conflicts = [] # type: List[LPD8AmbiguityReport.Conflict]
+
+    def __str__(self):
+        return "\n".join([str(x) for x in self.conflicts] + [str(x) for x in self.changes])
+
+class LPD8AmbiguitySolver():
+    """Makes notes, control changes and program changes unique across all programs in a single pass
+    Pad notes and pad program changes must be unique among pads, control changes among pads and knobs.
+    The first pad/knob using a value keeps it, later ones are moved to a free value by the allocator."""
+    def __init__(self, fix: bool=True, allocator: LPD8Allocator=None):
+        self.fix = fix
+        self.allocator = allocator if allocator is not None else LPD8Allocator()
+
+    def solve(self, programs: List[LPD8Program]) -> LPD8AmbiguityReport:
+        report = LPD8AmbiguityReport()
+        notes = [None] * 128    # type: List[Tuple[int, int, int]]
+        ccs = [None] * 128      # type: List[Tuple[int, int, int]]
+        pcs = [None] * 128      # type: List[Tuple[int, int, int]]
+
+        for programNum, program in enumerate(programs):
+            previous = {"note": None, "controlChange": None, "programChange": None}
+            for padNum, pad in enumerate(program.pads):
+                owner = (programNum, padNum, None)
+                self.claim(report, notes, pad, "note", owner, previous)
+                self.claim(report, ccs, pad, "controlChange", owner, previous)
+                self.claim(report, pcs, pad, "programChange", owner, previous)
+            previous["controlChange"] = None
+            for knobNum, knob in enumerate(program.knobs):
+                self.claim(report, ccs, knob, "controlChange", (programNum, None, knobNum), previous)
+
+        return report
+
+    def claim(self, report: LPD8AmbiguityReport, owners: List[Tuple[int, int, int]], control: Union[LPD8Program.Pad, LPD8Program.Knob],
+              field: str, owner: Tuple[int, int, int], previous: Dict[str, int]):
+        value = getattr(control, field)
+        if owners[value] is not None:
+            if self.fix:
+                newValue = self.allocator.allocate(owners, value, previous[field])
+                setattr(control, field, newValue)
+                report.changes.append(LPD8AmbiguityReport.Change(owner[0], owner[1], owner[2], field, value, newValue))
+                value = newValue
+            else:
+                report.conflicts.append(LPD8AmbiguityReport.Conflict(owner[0], owner[1], owner[2], field, value, owners[value]))
+                return
+        owners[value] = owner
+        previous[field] = value
+
+class LPD8CallbackWorker(threading.Thread):
+    """Runs callbacks of an LPD8Device from a bounded queue
+    Events of one pad/knob always go to the same worker, so they are delivered in order.
+    When the queue is full, backpressure decides what happens:
+    "block" waits for space, "dropOldest" discards the oldest queued event and
+    "coalesce" replaces a queued event of the same knob with the new value (dropping the oldest if there is none)."""
+    backpressurePolicies = ("block", "dropOldest", "coalesce")
+
+    def __init__(self, device: "LPD8Device", maxsize: int=256, backpressure: str="block"):
+        super(LPD8CallbackWorker, self).__init__(daemon=True)
+        if backpressure not in LPD8CallbackWorker.backpressurePolicies:
+            raise Exception("Unknown backpressure policy: %s (must be one of %s)" % (backpressure, ", ".join(LPD8CallbackWorker.backpressurePolicies)))
+        self.device = device
+        self.maxsize = maxsize
+        self.backpressure = backpressure
+        self.queue = collections.deque()    # type: collections.deque
+        self.condition = threading.Condition()
+        self.running = True
+        self.dropped = 0    # type: int
+        self.coalesced = 0  # type: int
+        self.errors = 0     # type: int
+
+    def put(self, key: Tuple[str, int], args: Tuple[int, int, int, int, int, float, Dict], coalescable: bool=False):
+        with self.condition:
+            if len(self.queue) >= self.maxsize:
+                if self.backpressure == "block":
+                    while len(self.queue) >= self.maxsize and self.running:
+                        self.condition.wait()
+                else:
+                    if self.backpressure == "coalesce" and coalescable:
+                        for i in range(len(self.queue) - 1, -1, -1):
+                            if self.queue[i][0] == key:
+                                self.queue[i] = (key, args)
+                                self.coalesced += 1
+                                return
+                    self.queue.popleft()
+                    self.dropped += 1
+            self.queue.append((key, args))
+            self.condition.notify_all()
+
+    def stop(self):
+        """Finish all queued callbacks, then end the thread"""
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.queue and self.running:
+                    self.condition.wait()
+                if not self.queue:
+                    return
+                key, args = self.queue.popleft()
+                self.condition.notify_all()
+            try:
+                self.device.dispatchCallback(*args)
+            except Exception:
+                self.errors += 1
+                traceback.print_exc()
 
 class LPD8Device():
+    programFetchWindow = 4              # type: int     # Number of program requests sent without waiting for a reply
+    programFetchTimeout = 2.0           # type: float   # Time after which getPrograms gives up
+    programFetchRetryInterval = 0.5     # type: float   # Time after which an unanswered program request is resent
+    programWriteInterval = 0.3          # type: float   # If programs are written too quickly, they won't be saved. Thanks Akai!
+    idleQueryInterval = 1.0             # type: float   # With trackProgram, query the active program this often while idle
+    lightFrameInterval = 1 / 30         # type: float   # Minimum time between two pad light frames
+    overrunTolerance = 0.005            # type: float   # Scheduled tasks running later than this count as overruns
+    portPrefix = "LPD8"                 # type: str     # freePortNames only lists ports starting with this
+    # Port bookkeeping, every backend keeps its own
+    occupiedDevicenames = []            # type: List[str]   # Ports opened by instances
+    occupiedLock = threading.Lock()
+    portNamesCache = None               # type: List[str]   # Port names of the last enumeration
+
     class CB():
-        def __init__(self):
+        kind = None     # type: str
+
+        def __init__(self, program: int, pad: int=None, knob: int=None):
             self.funcs = []
+            self.program = program
+            self.pad = pad
+            self.knob = knob
+
+        def trigger(self, value: int, noteon: int, noteoff: int, cc: int, pc: int):
+            for func in self.funcs:
+                func(self.program, self.pad, self.knob, value, noteon, noteoff, cc, pc)
 
     class PadNoteCB(CB):
+        kind = "note"
+
         def __init__(self, program: int, pad: int, note:int):
-            super(LPD8Device.PadNoteCB, self).__init__()
-            self.program = program
-            self.pad = pad
+            super(LPD8Device.PadNoteCB, self).__init__(program, pad=pad)
             self.note = note
+            self.key = (self.kind, note)
 
     class PadCCCB(CB):
+        kind = "cc"
+
         def __init__(self, program: int, pad: int, cc: int):
-            super(LPD8Device.PadCCCB, self).__init__()
-            self.program = program
-            self.pad = pad
+            super(LPD8Device.PadCCCB, self).__init__(program, pad=pad)
             self.cc = cc
+            self.key = (self.kind, cc)
 
     class PadPCCB(CB):
+        kind = "pc"
+
         def __init__(self, program: int, pad: int, pc: int):
-            super(LPD8Device.PadPCCB, self).__init__()
-            self.program = program
-            self.pad = pad
+            super(LPD8Device.PadPCCB, self).__init__(program, pad=pad)
             self.pc = pc
+            self.key = (self.kind, pc)
 
     class KnobCCCB(CB):
+        kind = "cc"
+
         def __init__(self, program: int, knob: int, cc: int):
-            super(LPD8Device.KnobCCCB, self).__init__()
-            self.program = program
-            self.knob = knob
+            super(LPD8Device.KnobCCCB, self).__init__(program, knob=knob)
             self.cc = cc
+            self.key = (self.kind, cc)
+
+    class Task():
+        """Function scheduled on the run() loop, see LPD8Device.schedule"""
+        def __init__(self, when: float, func: Callable[[], None], interval: float=None, name: str=None):
+            self.when = when            # time.monotonic() of the next run
+            self.func = func
+            self.interval = interval    # Periodic tasks run every interval seconds, one-shot tasks have None
+            self.name = name if name is not None else getattr(func, "__qualname__", repr(func))
+            self.cancelled = False
+            self.runs = 0
+            self.overruns = 0
+
+        def cancel(self):
+            self.cancelled = True
 
+        def __lt__(self, other: "LPD8Device.Task") -> bool:
+            return self.when < other.when
 
-    def __init__(self, solveAmbiguity: bool=False):
+
+    def __init__(self, solveAmbiguity: bool=False, autoSetup: Union[bool, str]=True, allocator: LPD8Allocator=None,
+                 programCache: "LPD8ProgramCache"=None, trustCache: bool=False):
         self.programs = [None, None, None, None]  # type: List[LPD8Program]
+        self.inQueue = queue.Queue()    # type: queue.Queue   # (time.perf_counter(), message) from the backend's input thread
+        self.deviceProgramData = [None, None, None, None]   # type: List[bytes]   # Programs as the device holds them, from the program number (byte 6) on
+        self.fetchMissing = []      # type: List[int]   # Slots whose program reply is still awaited, others are ignored
+        self.fetchRequested = {}    # type: Dict[int, float]   # Slot -> time.monotonic() of its last request
+        self.fetchDeadline = 0.0
+        self.programCache = programCache
+        self.trustCache = trustCache    # Use cached programs without reading them back from the device
         self.solveAmbiguity = solveAmbiguity
+        self.allocator = allocator  # type: LPD8Allocator
+        self.ambiguityReport = None # type: LPD8AmbiguityReport
 
         self.setupComplete = False
-        self.lastProgramWrite = time.time()
+        self.lastProgramWrite = 0.0     # time.monotonic() of the last program write
+        self.dirtyPrograms = {}         # type: Dict[int, List[concurrent.futures.Future]]   # Programs waiting to be written
+        self.writeLock = threading.Lock()
+        self.dispatchLock = threading.RLock()   # Held while messages change routing, coalesced values and pad lights, never while callbacks run
         self.lastProgramQuery = time.time()
+        self.lastProgramSeen = time.time()  # Last time the active program was known for sure, from input or a query
+        self.trackProgram = True    # Only query the active program while idle or unsure, input reveals it otherwise
+        self.programUncertain = False   # Input came that several programs emit
         self.programChangeCB = None
+        self.inputReadyCB = None    # Called from the backend's input thread whenever a message arrives
         self.currentProgram = 0
-
+        self.deviceId = None    # type: str   # Set by getDevice to identify the device, e.g. by its port name
+
+        self.cbList = []    # type: List[LPD8Device.CB]
+        self.programRoutes = [{}, {}, {}, {}]   # type: List[Dict[Tuple[str, int], List[LPD8Device.CB]]]   # Bindings per program
+        self.cbIndex = self.programRoutes[0]    # Routing table of the active program
+        self.controlPrograms = {}   # type: Dict[Tuple[str, int], Tuple[int, ...]]   # Control -> programs emitting it
+        self.controlIndex = {}  # type: Dict[Tuple[str, int], Tuple[int, int, int]]
+        self.eventListeners = []    # type: List[Callable[[LPD8Event], None]]
+        self.knobCCs = set()    # type: set   # Control changes emitted by knobs
+
+        self.coalesceKnobs = False
+        self.coalesceQuantum = 0.0
+        self.coalescedValues = {}   # type: Dict[int, Tuple[int, Dict]]   # Knob cc -> newest value not yet dispatched and its routing table
+        self.lastCoalesceFlush = 0.0
+        self.mergedKnobEvents = 0   # type: int
+
+        self.instrumentation = None # type: LPD8Instrumentation
+        self.receiptTime = None     # type: float   # time.perf_counter() at which the message being read was received
+        self.recorder = None        # type: LPD8Recorder
+        self.sharedState = None     # type: LPD8SharedState
+
+        self.knobMappings = {}      # type: Dict[Tuple[int, int], LPD8KnobMapping]   # (program, knob) -> mapping
+        self.knobTables = {}        # type: Dict[int, List[float]]   # Knob cc -> lookup table of its mapping
+
+        self.padLights = {}         # type: Dict[int, bool]   # Note -> light state last sent (or set by a pad press)
+        self.pendingLights = None   # type: Tuple[LPD8Program, List[bool]]    # Frame held back by lightFrameInterval
+        self.lastLightFrame = 0.0
+        self.lightPattern = None    # type: LPD8LightPattern
+        self.lightPatternStart = 0.0
+
+        self.sysexHandlers = {0x63: self.handleProgramSysex,        # Program reply
+                              0x64: self.handleActiveProgramSysex}  # Active program reply
+
+        self.callbackWorkers = None # type: List[LPD8CallbackWorker]
+        self.readerThread = None    # type: threading.Thread
+        self.readerRunning = False
+
+        self.tasks = []             # type: List[LPD8Device.Task]   # Heap of scheduled tasks, by time of their next run
+        self.taskLock = threading.Lock()
+        self.loopRunning = False
+        self.overrunCB = None       # Called with (task, lateness) whenever a task runs more than overrunTolerance late
+        self.overruns = 0
+
+        self.ready = concurrent.futures.Future()    # type: concurrent.futures.Future   # Completes with self after setup
+        if autoSetup == "background":
+            self.setupInBackground()
+        elif autoSetup:
+            self.setup()
+
+    def setup(self):
+        """Open the device, read all programs and make them unambiguous.
+        If this fails, the device is closed again so its port can be opened by a retry."""
         self.getDevice()
-        self.getPrograms()
-        self.checkAmbiguity()
+        try:
+            if not self.loadCachedPrograms():
+                self.getPrograms()
+            self.checkAmbiguity()
+            self.flushWrites(block=True)
+            self.storeCachedPrograms()
+            self.completeSetup()
+        except:
+            self.abortSetup()
+            raise
+
+    def abortSetup(self):
+        """Release what a failed setup got hold of"""
+        if self.deviceId is not None:   # getDevice got the port, close releases it
+            self.close()
+
+    def setupInBackground(self) -> concurrent.futures.Future:
+        """Run setup() in a thread and return the ready future, which fails with the exception if setup fails.
+        A failed setup has released the port again by then, see abortSetup. Don't use the device until it is ready."""
+        def run():
+            try:
+                self.setup()
+            except BaseException as e:
+                if not self.ready.done():
+                    self.ready.set_exception(e)
+
+        threading.Thread(target=run, daemon=True).start()
+        return self.ready
+
+    def loadCachedPrograms(self) -> bool:
+        """Take programs from the program cache instead of reading them back, if trustCache is set.
+        Without trustCache the cache is only kept up to date, all programs are read from the device."""
+        if self.programCache is None or not self.trustCache:
+            return False
+        programs = self.programCache.load(self.deviceId)
+        if programs is None:
+            return False
+        self.programs = programs
+        self.deviceProgramData = [program.writeProgram()[6:] for program in programs]
+        return True
+
+    def storeCachedPrograms(self):
+        if self.programCache is not None:
+            self.programCache.store(self.deviceId, self.programs)
+
+    def completeSetup(self):
+        self.buildControlIndex()
+        self.buildKnobTables()
 
         # From this point programs must not be changed
         self.setupComplete = True
-
-        self.cbList = []
+        if not self.ready.done():
+            self.ready.set_result(self)
 
     def getDevice(self):
         """Open midi IO to LPD8"""
         raise NotImplementedError
 
-    def getPrograms(self):
-        for i in range(4):
-            self.writeSysex([0x47, 0x7F, 0x75, 0x63, 0x00, 0x01, 1+i])  # Request program 1 to 4
-            self.readMidi(True)    # Wait up to one second for response
-            if self.programs[i] is None:    # If response came within one second, program slot will be filled
-                raise Exception("Reading Program data timed out")
-            if self.solveAmbiguity:     # Only do this when user consents!
-                for pad in self.programs[i].pads:       # Set toggle to off for all pads
-                    pad.toggle = False
-                for knob in self.programs[i].knobs:     # Set knob range to 0-127
-                    knob.low = 0
-                    knob.high = 127
+    @classmethod
+    def enumeratePorts(cls) -> List[str]:
+        """Names of all midi ports the backend can open"""
+        raise NotImplementedError
 
-        self.writeSysex(data=[0x47, 0x7F, 0x75, 0x64, 0x00, 0x00])  # Query active program
+    @classmethod
+    def portNames(cls, refresh: bool=False) -> List[str]:
+        """Names of all midi ports, enumerated once per process unless refresh is set"""
+        if refresh or cls.portNamesCache is None:
+            cls.portNamesCache = cls.enumeratePorts()
+        return cls.portNamesCache
+
+    @classmethod
+    def freePortNames(cls, refresh: bool=False) -> List[str]:
+        """Names of all LPD8 ports that aren't yet occupied by class-instances"""
+        return [x for x in cls.portNames(refresh) if x.startswith(cls.portPrefix) and x not in cls.occupiedDevicenames]
+
+    def claimPort(self):
+        """Occupy portName, or the first free port if it is None"""
+        cls = type(self)
+        with cls.occupiedLock:
+            portnames = cls.freePortNames()
+            if self.portName is not None:
+                portnames = [x for x in portnames if x == self.portName]
+            if not portnames:   # Devices may have been plugged in since the ports were enumerated
+                portnames = cls.freePortNames(refresh=True)
+                if self.portName is not None:
+                    portnames = [x for x in portnames if x == self.portName]
+
+            if not portnames:
+                if self.portName is not None:
+                    raise Exception("LPD8 device %s is not available" % self.portName)
+                raise Exception("No free LPD8 devices left")
+            self.portName = portnames[0]
+            cls.occupiedDevicenames.append(self.portName)
+
+    def releasePort(self):
+        cls = type(self)
+        with cls.occupiedLock:
+            if self.portName in cls.occupiedDevicenames:
+                cls.occupiedDevicenames.remove(self.portName)
+
+    def close(self):
+        """Stop threaded dispatch, sharing state and recording, and release midi IO"""
+        self.stopThreadedDispatch()
+        self.stopSharingState()
+        self.stopRecording()
 
+    def getPrograms(self):
+        """Read all four programs from the device"""
+        self.fetchPrograms([0, 1, 2, 3])
+        self.queryActiveProgram()
+
+    def fetchPrograms(self, slots: List[int], timeout: float=None):
+        """Read the programs in slots from the device, see startProgramFetch"""
+        self.startProgramFetch(slots, timeout)
+        while self.fetchMissing:
+            self.readMidi(timeout=self.requestPrograms())
+
+    def startProgramFetch(self, slots: List[int], timeout: float=None):
+        """Start awaiting the programs in slots. Only one reply per awaited slot is taken, duplicate replies to resent
+        requests and replies nobody asked for are ignored. Call requestPrograms() until fetchMissing is empty."""
+        self.fetchMissing = list(slots)
+        self.fetchRequested = {}
+        self.fetchDeadline = time.monotonic() + (self.programFetchTimeout if timeout is None else timeout)
+
+    def requestPrograms(self) -> float:
+        """Send the program requests that are due and return how many seconds to wait for replies before calling again.
+        Up to programFetchWindow requests are outstanding at once, replies are matched to their slot by program index.
+        Unanswered requests are resent every programFetchRetryInterval seconds until the fetch timed out."""
+        now = time.monotonic()
+        if now > self.fetchDeadline:
+            self.fetchMissing = []
+            raise Exception("Reading Program data timed out")
+        for i in self.fetchMissing:
+            if i in self.fetchRequested:
+                if now < self.fetchRequested[i] + self.programFetchRetryInterval:
+                    continue
+            elif len(self.fetchRequested) >= self.programFetchWindow:
+                break
+            self.writeSysex([0x47, 0x7F, 0x75, 0x63, 0x00, 0x01, 1+i])  # Request program i+1
+            self.fetchRequested[i] = now
+
+        nextRetry = min(self.fetchRequested.values()) + self.programFetchRetryInterval
+        return max(0.0, min(self.fetchDeadline, nextRetry) - time.monotonic())
+
+    def normalizeProgram(self, program: LPD8Program):
+        if self.solveAmbiguity:     # Only do this when user consents!
+            for pad in program.pads:       # Set toggle to off for all pads
+                pad.toggle = False
+            for knob in program.knobs:     # Set knob range to 0-127
+                knob.low = 0
+                knob.high = 127
 
     def checkAmbiguity(self):
-        # Iterate over all settings and make sure they're unique. Otherwise throw exception
-        for program in self.programs:
-            for pad in program.pads:
-                ambiguities = self.findAmbiguity(pad)
-                if ambiguities:
-                    if self.solveAmbiguity:
-                        self.fixAmbiguity(self.programs.index(program), pad)
-                    else:
-                        raise Exception("Ambiguity between program %s/%s and %s" % (self.programs.index(program), pad, ambiguities))
-            for knob in program.knobs:
-                ambiguities = self.findAmbiguity(knob)
-                if ambiguities:
-                    if self.solveAmbiguity:
-                        self.fixAmbiguity(self.programs.index(program), knob)
-                    else:
-                        raise Exception("Ambiguity between program %s/%s and %s" % (self.programs.index(program), knob, ambiguities))
-
-
-        for program in self.programs:
-            self.writeSysex(program.writeProgram())
-            time.sleep(0.3)     # If write commands are sent too fast, it won't work :/
+        """Resolve ambiguities and queue all programs for writing, programs the device already holds are skipped"""
+        self.resolveAmbiguity()
 
-        self.setActiveProgram(0)
+        for programNum in range(4):
+            self.queueProgramWrite(programNum)
 
-    def findAmbiguity(self, toCheck: Union[LPD8Program.Pad, LPD8Program.Knob]) -> List[Union[LPD8Program.Pad, LPD8Program.Knob]]:
-        ambiguities = []
-        for program in self.programs:
-            if type(toCheck) is LPD8Program.Pad:
-                for pad in program.pads:
-                    if toCheck.note == pad.note or toCheck.controlChange == pad.controlChange or toCheck.programChange == pad.programChange:
-                        ambiguities.append(pad)
-                for knob in program.knobs:
-                    if toCheck.controlChange == knob.controlChange:
-                        ambiguities.append(knob)
-            elif type(toCheck) is LPD8Program.Knob:
-                for knob in program.knobs:
-                    if toCheck.controlChange == knob.controlChange:
-                        ambiguities.append(knob)
-                for pad in program.pads:
-                    if toCheck.controlChange == pad.controlChange:
-                        ambiguities.append(pad)
-
-        if toCheck in ambiguities:
-            ambiguities.remove(toCheck)
-        return ambiguities
-
-    def fixAmbiguity(self, programIndex: int, toFix: Union[LPD8Program.Pad, LPD8Program.Knob]):
-        """Increase pad/knob values until no ambiguity is present."""
-        print("fixing ambiguity of: %s (Program %s)" % (toFix, programIndex))
-        if type(toFix) is LPD8Program.Pad:
-            for i in range(127):    # Fix all note conflicts
-                ambiguities = self.findAmbiguity(toFix)
-                if not [x for x in [x for x in ambiguities if type(x) is LPD8Program.Pad] if x.note == toFix.note]:
-                    break
-                toFix.note = (toFix.note + 1) % 128
-            else:
-                raise Exception("Couldn't fix note ambiguity between program %s/%s and %s" % (programIndex, toFix, ambiguities))
+        self.setActiveProgram(0)
 
-            for i in range(127):    # Fix all controlchange conflicts
-                ambiguities = self.findAmbiguity(toFix)
-                if not [x for x in ambiguities if x.controlChange == toFix.controlChange]:
-                    break
-                toFix.controlChange = (toFix.controlChange + 1) % 128
-            else:
-                raise Exception("Couldn't fix controlChange ambiguity between program %s/%s and %s" % (programIndex, toFix, ambiguities))
+    def resolveAmbiguity(self) -> LPD8AmbiguityReport:
+        """Make sure all settings are unique. Fixes them if solveAmbiguity is set, otherwise throws an exception"""
+        report = LPD8AmbiguitySolver(self.solveAmbiguity, self.allocator).solve(self.programs)
+        self.ambiguityReport = report
+        if report.conflicts:
+            raise Exception("Ambiguities found:\n%s" % report)
+        return report
+
+    def buildControlIndex(self):
+        """Map every note/cc/pc the programs emit to the (program, pad, knob) it belongs to"""
+        self.controlIndex = {}
+        for programNum, program in enumerate(self.programs):
+            for padNum, pad in enumerate(program.pads):
+                self.controlIndex[("note", pad.note)] = (programNum, padNum, None)
+                self.controlIndex[("cc", pad.controlChange)] = (programNum, padNum, None)
+                self.controlIndex[("pc", pad.programChange)] = (programNum, padNum, None)
+            for knobNum, knob in enumerate(program.knobs):
+                self.controlIndex[("cc", knob.controlChange)] = (programNum, None, knobNum)
+        self.knobCCs = set(key[1] for key, control in self.controlIndex.items() if control[2] is not None)
+
+        controlPrograms = {}    # type: Dict[Tuple[str, int], List[int]]
+        for programNum, program in enumerate(self.programs):
+            keys = set()
+            for pad in program.pads:
+                keys.update((("note", pad.note), ("cc", pad.controlChange), ("pc", pad.programChange)))
+            keys.update(("cc", knob.controlChange) for knob in program.knobs)
+            for key in keys:
+                controlPrograms.setdefault(key, []).append(programNum)
+        self.controlPrograms = {key: tuple(programs) for key, programs in controlPrograms.items()}
+
+    def buildKnobTables(self):
+        """Look up the tables of all knob mappings for the current programs"""
+        knobTables = {}
+        for (programNum, knobNum), mapping in self.knobMappings.items():
+            knob = self.programs[programNum].knobs[knobNum]
+            knobTables[knob.controlChange] = mapping.buildTable(knob.low, knob.high)
+        self.knobTables = knobTables
+
+    def setKnobMapping(self, programNum: int, knobNum: int, mapping: "LPD8KnobMapping"):
+        """Deliver values of a knob mapped through mapping (see lpd8mapping) to callbacks and event listeners,
+        None delivers raw values again"""
+        if mapping is None:
+            self.knobMappings.pop((programNum, knobNum), None)
+        else:
+            self.knobMappings[(programNum, knobNum)] = mapping
+        if self.setupComplete:
+            self.buildKnobTables()
+
+    def mapKnobValues(self, programNum: int, knobNum: int, values):
+        """Map a buffer of raw values of a knob through its mapping at once, needs numpy"""
+        knob = self.programs[programNum].knobs[knobNum]
+        return self.knobMappings[(programNum, knobNum)].mapArray(values, knob.low, knob.high)
 
-            for i in range(127):    # Fix all controlchange conflicts
-                ambiguities = self.findAmbiguity(toFix)
-                if not [x for x in [x for x in ambiguities if type(x) is LPD8Program.Pad] if x.programChange == toFix.programChange]:
-                    break
-                toFix.programChange = (toFix.programChange + 1) % 128
-            else:
-                raise Exception("Couldn't fix programChange ambiguity between program %s/%s and %s" % (programIndex, toFix, ambiguities))
-
-        elif type(toFix) is LPD8Program.Knob:
-            for i in range(127):    # Fix all note conflicts
-                ambiguities = self.findAmbiguity(toFix)
-                if not [x for x in ambiguities if x.controlChange == toFix.controlChange]:
-                    break
-                toFix.controlChange = (toFix.controlChange + 1) % 128
-            else:
-                raise Exception("Couldn't fix controlChange ambiguity between program %s/%s and %s" % (programIndex, toFix, ambiguities))
+    def addEventListener(self, listener: Callable[[LPD8Event], None]):
+        """Call listener with an LPD8Event for every pad and knob event, bound or not"""
+        if listener not in self.eventListeners:
+            self.eventListeners.append(listener)
 
-        print("                -> %s" % toFix)
+    def removeEventListener(self, listener: Callable[[LPD8Event], None]):
+        if listener in self.eventListeners:
+            self.eventListeners.remove(listener)
 
-    def triggerCallback(self, noteon: int, noteoff: int, cc: int, pc: int, value: int=None):
+    def triggerCallback(self, noteon: int, noteoff: int, cc: int, pc: int, value: int=None, receivedAt: float=None):
         # Callback signature: callback(programNum: int, padNum: int, knobNum: int, value: int, noteon: int, noteoff: int, cc: int, pc: int) -> None
-        for cb in self.cbList:
-            if type(cb) == LPD8Device.PadNoteCB and noteon is not None and cb.note == noteon:
-                for func in cb.funcs:
-                    func(cb.program, cb.pad, None, value, noteon, None, None, None)
-                return
-            elif type(cb) == LPD8Device.PadNoteCB and noteoff is not None and cb.note == noteoff:
-                for func in cb.funcs:
-                    func(cb.program, cb.pad, None, value, None, noteoff, None, None)
-                return
-            elif type(cb) == LPD8Device.PadPCCB and pc is not None and cb.pc == pc:
-                for func in cb.funcs:
-                    func(cb.program, cb.pad, None, None, None, None, None, pc)
-                return
-            elif type(cb) == LPD8Device.KnobCCCB and cc is not None and cb.cc == cc:
+        if receivedAt is None:
+            receivedAt = self.receiptTime
+        if self.recorder is not None:
+            self.recorder.recordControl(noteon, noteoff, cc, pc, value)
+        # Device state is changed under dispatchLock, callbacks run and queues block only after it is released
+        with self.dispatchLock:
+            newProgram = None
+            if noteon is not None:     # Switch routing before dispatching, if the control reveals the program
+                newProgram = self.inferProgram(("note", noteon))
+            elif noteoff is not None:
+                newProgram = self.inferProgram(("note", noteoff))
+            elif cc is not None:
+                newProgram = self.inferProgram(("cc", cc))
+            elif pc is not None:
+                newProgram = self.inferProgram(("pc", pc))
+            if self.sharedState is not None:
+                self.updateSharedState(noteon, noteoff, cc, value)
+            if self.padLights:     # Pressing and releasing a pad changes its light
+                if noteon is not None:
+                    self.padLights[noteon] = True
+                elif noteoff is not None:
+                    self.padLights[noteoff] = False
+            routes = self.cbIndex   # Delayed dispatch must still route by the program active when the message arrived
+            coalesce = self.coalesceKnobs and cc is not None and cc in self.knobCCs
+            if coalesce:
+                if cc in self.coalescedValues:
+                    self.mergedKnobEvents += 1
+                self.coalescedValues[cc] = (value, routes)
+
+        if newProgram is not None and callable(self.programChangeCB):
+            self.programChangeCB(newProgram)
+        if coalesce:
+            return
+        if self.callbackWorkers is not None:
+            self.queueCallback(noteon, noteoff, cc, pc, value, receivedAt, routes)
+        else:
+            self.dispatchCallback(noteon, noteoff, cc, pc, value, receivedAt, routes)
+
+    def inferProgram(self, key: Tuple[str, int]) -> int:
+        """Switch to the program that emits a control. If several programs emit it, the next tick() queries the device.
+        Returns the new program if it changed."""
+        programs = self.controlPrograms.get(key)
+        if programs is None:
+            return None
+        if len(programs) == 1:
+            self.lastProgramSeen = time.time()
+            if self.switchProgram(programs[0]):
+                return programs[0]
+        else:
+            self.programUncertain = True
+        return None
+
+    def setKnobCoalescing(self, enabled: bool=True, quantum: float=0.0):
+        """Only deliver the newest value of each knob.
+        Values are collected while midi is read and delivered after each tick(), or at most every quantum seconds.
+        Pad events are never merged."""
+        if not enabled:
+            self.flushCoalesced(force=True)
+        self.coalesceKnobs = enabled
+        self.coalesceQuantum = quantum
+
+    def flushCoalesced(self, force: bool=False):
+        """Deliver the newest value of every knob that changed since the last flush"""
+        if not self.coalescedValues:
+            return
+        now = time.monotonic()
+        if not force and now < self.lastCoalesceFlush + self.coalesceQuantum:
+            return
+        self.lastCoalesceFlush = now
+        with self.dispatchLock:
+            values = self.coalescedValues
+            self.coalescedValues = {}
+        for cc, (value, routes) in values.items():
+            if self.callbackWorkers is not None:
+                self.queueCallback(None, None, cc, None, value, self.receiptTime, routes)
+            else:
+                self.dispatchCallback(None, None, cc, None, value, self.receiptTime, routes)
+
+    def queueCallback(self, noteon: int, noteoff: int, cc: int, pc: int, value: int=None, receivedAt: float=None,
+                      routes: Dict[Tuple[str, int], List["LPD8Device.CB"]]=None):
+        if noteon is not None:
+            key = ("note", noteon)
+        elif noteoff is not None:
+            key = ("note", noteoff)
+        elif cc is not None:
+            key = ("cc", cc)
+        elif pc is not None:
+            key = ("pc", pc)
+        else:
+            return
+        control = self.controlIndex.get(key)
+        coalescable = control is not None and control[2] is not None   # Only knob values may be merged
+        workers = self.callbackWorkers
+        if routes is None:
+            routes = self.cbIndex
+        workers[hash(key) % len(workers)].put(key, (noteon, noteoff, cc, pc, value, receivedAt, routes), coalescable)
+
+    def dispatchCallback(self, noteon: int, noteoff: int, cc: int, pc: int, value: int=None, receivedAt: float=None,
+                         routes: Dict[Tuple[str, int], List["LPD8Device.CB"]]=None):
+        """Call all callbacks and event listeners for a message.
+        routes is the routing table of the program the message belongs to, the active program's if None."""
+        if noteon is not None:
+            key = ("note", noteon)
+        elif noteoff is not None:
+            key = ("note", noteoff)
+        elif cc is not None:
+            key = ("cc", cc)
+        elif pc is not None:
+            key = ("pc", pc)
+        else:
+            return
+
+        if self.knobTables and cc is not None:
+            table = self.knobTables.get(cc)
+            if table is not None:
+                value = table[value]
+
+        if routes is None:
+            routes = self.cbIndex
+        if self.instrumentation is not None:
+            self.dispatchInstrumented(key, noteon, noteoff, cc, pc, value, receivedAt, routes)
+            return
+
+        cbs = routes.get(key)
+        if cbs:
+            for cb in cbs:
+                cb.trigger(value, noteon, noteoff, cc, pc)
+
+        if self.eventListeners:
+            control = self.controlIndex.get(key)
+            if control is not None:
+                event = LPD8Event(control[0], control[1], control[2], value, noteon, noteoff, cc, pc, self.deviceId)
+                for listener in self.eventListeners:
+                    listener(event)
+
+    def dispatchInstrumented(self, key: Tuple[str, int], noteon: int, noteoff: int, cc: int, pc: int, value: int, receivedAt: float,
+                             routes: Dict[Tuple[str, int], List["LPD8Device.CB"]]):
+        """dispatchCallback, timing each step"""
+        instrumentation = self.instrumentation
+        dispatchedAt = time.perf_counter()
+        if receivedAt is not None:
+            instrumentation.record("receiptToDispatch", key[0], dispatchedAt - receivedAt)
+
+        cbs = routes.get(key)
+        if cbs:
+            for cb in cbs:
                 for func in cb.funcs:
-                    func(cb.program, None, cb.knob, value, None, None, cc, None)
+                    start = time.perf_counter()
+                    func(cb.program, cb.pad, cb.knob, value, noteon, noteoff, cc, pc)
+                    instrumentation.record("callback", getattr(func, "__qualname__", repr(func)), time.perf_counter() - start)
+
+        if self.eventListeners:
+            control = self.controlIndex.get(key)
+            if control is not None:
+                event = LPD8Event(control[0], control[1], control[2], value, noteon, noteoff, cc, pc, self.deviceId)
+                for listener in self.eventListeners:
+                    listener(event)
+        instrumentation.record("dispatchToComplete", key[0], time.perf_counter() - dispatchedAt)
+
+    def shareState(self, name: str=None) -> "LPD8SharedState":
+        """Publish knob values, pad states and the active program in a shared memory segment.
+        Other processes read it with LPD8SharedStateReader(state.name), see lpd8shared."""
+        from lpd8shared import LPD8SharedState
+        self.stopSharingState()
+        state = LPD8SharedState(name)
+        state.setProgram(self.currentProgram)
+        self.sharedState = state
+        return state
+
+    def stopSharingState(self):
+        if self.sharedState is not None:
+            state = self.sharedState
+            self.sharedState = None
+            state.close()
+
+    def updateSharedState(self, noteon: int, noteoff: int, cc: int, value: int):
+        if noteon is not None:
+            control = self.controlIndex.get(("note", noteon))
+            if control is not None:
+                self.sharedState.setPad(control[0], control[1], True, value)
+        elif noteoff is not None:
+            control = self.controlIndex.get(("note", noteoff))
+            if control is not None:
+                self.sharedState.setPad(control[0], control[1], False)
+        elif cc is not None:
+            control = self.controlIndex.get(("cc", cc))
+            if control is None:
                 return
-
-    def tick(self, queryInterval: float=0.1) -> None:
-        self.readMidi()
-
-        if time.time() > self.lastProgramQuery + queryInterval:
-            self.writeSysex(data=[0x47, 0x7F, 0x75, 0x64, 0x00, 0x00])  # Query current program
-            self.lastProgramQuery = time.time()
+            if control[2] is not None:
+                self.sharedState.setKnob(control[0], control[2], value)
+            else:   # Pads in CC mode send 0 on release
+                self.sharedState.setPad(control[0], control[1], value > 0, value)
+
+    def startRecording(self, path: str) -> "LPD8Recorder":
+        """Record the programs and every message read from now on to path, see LPD8Replay to play it back"""
+        from lpd8record import LPD8Recorder
+        self.stopRecording()
+        self.recorder = LPD8Recorder(path, self.programs)
+        return self.recorder
+
+    def stopRecording(self):
+        if self.recorder is not None:
+            recorder = self.recorder
+            self.recorder = None
+            recorder.close()
+
+    def enableInstrumentation(self, sampleHook: Callable[[str, str, float], None]=None) -> LPD8Instrumentation:
+        """Start collecting latency histograms and counters, see stats()"""
+        self.instrumentation = LPD8Instrumentation(sampleHook)
+        return self.instrumentation
+
+    def disableInstrumentation(self):
+        self.instrumentation = None
+
+    def stats(self) -> Dict[str, object]:
+        """Snapshot of instrumentation histograms and counters, together with dispatchStats()"""
+        stats = self.instrumentation.stats() if self.instrumentation is not None else {"counters": {}}
+        stats["dispatch"] = self.dispatchStats()
+        return stats
+
+    def startThreadedDispatch(self, workers: int=1, queueSize: int=256, backpressure: str="block", queryInterval: float=0.1):
+        """Read midi on a dedicated thread and run callbacks on a pool of worker threads.
+        Don't call tick() while threaded dispatch is running."""
+        if self.readerThread is not None:
+            raise Exception("Threaded dispatch is already running")
+        callbackWorkers = [LPD8CallbackWorker(self, queueSize, backpressure) for i in range(workers)]
+        for worker in callbackWorkers:
+            worker.start()
+        self.callbackWorkers = callbackWorkers
+
+        self.readerRunning = True
+        self.readerThread = threading.Thread(target=self.readLoop, args=(queryInterval,), daemon=True)
+        self.readerThread.start()
+
+    def stopThreadedDispatch(self):
+        """Stop the reader thread and wait until all queued callbacks have run"""
+        if self.readerThread is None:
+            return
+        self.readerRunning = False
+        self.readerThread.join()
+        self.readerThread = None
+
+        for worker in self.callbackWorkers:
+            worker.stop()
+        for worker in self.callbackWorkers:
+            worker.join()
+        self.callbackWorkers = None
+
+    def readLoop(self, queryInterval: float):
+        while self.readerRunning:
+            self.tick(queryInterval, timeout=queryInterval)
+
+    def dispatchStats(self) -> Dict[str, int]:
+        """Counters of threaded dispatch (events queued, dropped or coalesced and callbacks that raised)
+        and knob coalescing (knob events merged)"""
+        workers = self.callbackWorkers or []
+        return {"queued": sum(len(worker.queue) for worker in workers),
+                "dropped": sum(worker.dropped for worker in workers),
+                "coalesced": sum(worker.coalesced for worker in workers),
+                "errors": sum(worker.errors for worker in workers),
+                "merged": self.mergedKnobEvents}
+
+    def tick(self, queryInterval: float=0.1, timeout: float=0.0) -> None:
+        """Process incoming midi and query the active program when due, see nextQueryTime.
+        With a timeout, block for up to timeout seconds (but never past the next program query) until input arrives."""
+        if timeout > 0:
+            timeout = min(timeout, max(0.0, self.nextQueryTime(queryInterval) - time.time()))
+            if self.dirtyPrograms:
+                timeout = min(timeout, max(0.0, self.lastProgramWrite + self.programWriteInterval - time.monotonic()))
+            if self.coalescedValues:
+                timeout = min(timeout, max(0.0, self.lastCoalesceFlush + self.coalesceQuantum - time.monotonic()))
+            if self.lightPattern is not None or self.pendingLights is not None:
+                timeout = min(timeout, max(0.0, self.lastLightFrame + self.lightFrameInterval - time.monotonic()))
+        self.readMidi(timeout=timeout)
+        self.flushCoalesced()
+        self.updateLights()
+        self.flushWrites()
+
+        if time.time() > self.nextQueryTime(queryInterval):
+            self.queryActiveProgram()
+
+    def schedule(self, delay: float, func: Callable[[], None], interval: float=None, name: str=None) -> "LPD8Device.Task":
+        """Run func on the run() loop after delay seconds, and then every interval seconds if interval is set.
+        Periodic tasks keep their rate: if the loop falls behind, missed runs are skipped, not run in a burst."""
+        if interval is not None and interval <= 0:
+            raise Exception("Task interval must be positive: %s" % interval)
+        task = LPD8Device.Task(time.monotonic() + delay, func, interval, name)
+        with self.taskLock:
+            heapq.heappush(self.tasks, task)
+            first = self.tasks[0] is task
+        if first and self.loopRunning:  # The loop may be asleep until a later task, or input
+            self.wakeLoop()
+        return task
+
+    def runTasks(self) -> float:
+        """Run all due tasks, returns the time.monotonic() at which the next one is due (None if there is none)"""
+        while True:
+            now = time.monotonic()
+            with self.taskLock:
+                while self.tasks and self.tasks[0].cancelled:
+                    heapq.heappop(self.tasks)
+                if not self.tasks:
+                    return None
+                if self.tasks[0].when > now:
+                    return self.tasks[0].when
+                task = heapq.heappop(self.tasks)
+
+            lateness = now - task.when
+            if lateness > self.overrunTolerance:
+                self.reportOverrun(task, lateness)
+            task.runs += 1
+            task.func()
+
+            if task.interval is not None and not task.cancelled:
+                task.when += task.interval
+                now = time.monotonic()
+                if task.when <= now:    # Took longer than its interval or the loop was blocked, skip missed runs
+                    task.when += (int((now - task.when) / task.interval) + 1) * task.interval
+                with self.taskLock:
+                    heapq.heappush(self.tasks, task)
+
+    def reportOverrun(self, task: "LPD8Device.Task", lateness: float):
+        task.overruns += 1
+        self.overruns += 1
+        if self.instrumentation is not None:
+            self.instrumentation.count("overruns")
+            self.instrumentation.record("taskLateness", task.name, lateness)
+        if callable(self.overrunCB):
+            self.overrunCB(task, lateness)
+
+    def run(self, queryInterval: float=0.1):
+        """Process input and scheduled tasks until stop() is called"""
+        self.runUntil(None, queryInterval=queryInterval)
+
+    def runUntil(self, until: Union[Callable[[], bool], concurrent.futures.Future]=None, timeout: float=None,
+                 queryInterval: float=0.1) -> bool:
+        """Process input and scheduled tasks until until() is true or the future until is done, timeout seconds have
+        passed or stop() is called. Sleeps until input arrives or the next task, program query, program write,
+        knob flush or light frame is due. Returns whether until was met."""
+        if self.readerThread is not None:
+            raise Exception("Can't run the loop while threaded dispatch is running")
+        if isinstance(until, concurrent.futures.Future):
+            until = until.done
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        self.loopRunning = True
+        try:
+            while True:
+                nextTask = self.runTasks()
+                if until is not None and until():
+                    return True
+                if not self.loopRunning:
+                    return False
+                now = time.monotonic()
+                if deadline is not None and now >= deadline:
+                    return False
+                wait = 3600.0   # tick() shortens this to the next program query and any other pending work
+                if nextTask is not None:
+                    wait = nextTask - now
+                if deadline is not None:
+                    wait = min(wait, deadline - now)
+                self.tick(queryInterval, timeout=max(wait, 1e-6))
+        finally:
+            self.loopRunning = False
+
+    def stop(self):
+        """Make run()/runUntil() return, also from another thread"""
+        if self.loopRunning:
+            self.loopRunning = False
+            self.wakeLoop()
+
+    def wakeLoop(self):
+        """Make a readMidi blocked on the input queue return, so the loop notices new tasks or stop()"""
+        self.inQueue.put((time.perf_counter(), None))
+
+    def nextQueryTime(self, queryInterval: float=0.1) -> float:
+        """time.time() at which tick() queries the active program next.
+        Without trackProgram that is every queryInterval. With it, the device is only queried every idleQueryInterval
+        while no input revealed the program, or after queryInterval if input was ambiguous."""
+        if not self.trackProgram or self.programUncertain:
+            return self.lastProgramQuery + queryInterval
+        return max(self.lastProgramQuery, self.lastProgramSeen) + max(queryInterval, self.idleQueryInterval)
+
+    def queryActiveProgram(self):
+        self.writeSysex(data=[0x47, 0x7F, 0x75, 0x64, 0x00, 0x00])  # Query current program
+        self.lastProgramQuery = time.time()
+        if self.instrumentation is not None:
+            self.instrumentation.count("programQueries")
 
     def writeProgram(self, data: List[int]):
-        """If programs are written too quickly, they won't be saved. Thanks Akai!"""
-        while self.lastProgramWrite + 0.3 < time.time():
-            pass
-        self.writeSysex(data)
-        self.lastProgramWrite = time.time()
+        """Write sysex program data (see LPD8Program.writeProgram) right away, blocking until programWriteInterval
+        has passed since the last write. queueProgramWrite doesn't block."""
+        with self.writeLock:
+            wait = self.lastProgramWrite + self.programWriteInterval - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            self.writeSysex(data)
+            self.lastProgramWrite = time.monotonic()
+            self.deviceProgramData[data[6] - 1] = bytes(data[6:])
+
+    def queueProgramWrite(self, programNum: int) -> concurrent.futures.Future:
+        """Queue a program for writing to the device. Doesn't block, the write is sent by tick() or flushWrites().
+        Repeated calls before the write went out are merged into one write of the latest program state.
+        The returned future completes once the program was written."""
+        if not 0 <= programNum <= 3:
+            raise Exception("Program index out of range: %s (must be 0-3)" % programNum)
+        future = concurrent.futures.Future()    # type: concurrent.futures.Future
+        with self.writeLock:
+            self.dirtyPrograms.setdefault(programNum, []).append(future)
+        return future
+
+    def pendingWrites(self) -> int:
+        """Number of programs waiting to be written"""
+        return len(self.dirtyPrograms)
+
+    def nextWriteTime(self) -> float:
+        """time.monotonic() at which the next queued program can be written, None if there is none"""
+        if not self.dirtyPrograms:
+            return None
+        return self.lastProgramWrite + self.programWriteInterval
+
+    def flushWrites(self, block: bool=False, timeout: float=None) -> bool:
+        """Write queued programs, at most one every programWriteInterval seconds.
+        Without block only writes that are due right now are sent. With block, wait (while processing midi input)
+        until all programs are written or timeout has passed. Returns True if no writes are pending anymore."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            written = False
+            with self.writeLock:
+                if not self.dirtyPrograms:
+                    return True
+                now = time.monotonic()
+                for programNum in sorted(self.dirtyPrograms):
+                    data = self.programs[programNum].writeProgram()
+                    if data[6:] == self.deviceProgramData[programNum]:  # Device already holds this program, channel included
+                        self.resolveWrite(programNum)
+                    elif now >= self.lastProgramWrite + self.programWriteInterval:
+                        self.writeSysex(data)
+                        self.lastProgramWrite = now
+                        if self.instrumentation is not None:
+                            self.instrumentation.count("programWrites")
+                        self.deviceProgramData[programNum] = data[6:]
+                        self.resolveWrite(programNum)
+                        written = True
+                done = not self.dirtyPrograms
+                wait = self.lastProgramWrite + self.programWriteInterval - now
+
+            if written:     # Keep the cache in line with the device, also for changes made after setup
+                self.storeCachedPrograms()
+            if done:
+                return True
+
+            if not block:
+                return False
+            if deadline is not None:
+                if now >= deadline:
+                    return False
+                wait = min(wait, deadline - now)
+            self.readMidi(timeout=max(0.0, wait))
+
+    def resolveWrite(self, programNum: int):
+        for future in self.dirtyPrograms.pop(programNum):
+            future.set_result(True)
 
     def lightPad(self, pad:int, on:bool =True):
         if not 0 <= pad <= 7:
-            raise("Pad out of range: %s (must be 0-7)" % pad)
+            raise Exception("Pad out of range: %s (must be 0-7)" % pad)
         curProg = self.programs[self.currentProgram]
         pad = curProg.pads[pad]
 
-        self.writeNote(pad.note, on)
-
-    def addPadCB(self, programNum: int, padNum: int, CB: Callable[[int, int, int, int, int], None], note: bool=True, cc: bool=False, pc: bool=False):
-        if not 0 <= programNum <= 3:
+        with self.dispatchLock:
+            self.writeNote(pad.note, on)
+            self.padLights[pad.note] = on
+
+    def setPadLights(self, states: List[bool], programNum: int=None) -> int:
+        """Set the lights of all pads of a program (the active one if None) at once.
+        Only pads whose light changed since the last frame are sent. Frames are sent at most every lightFrameInterval
+        seconds, a frame set earlier is held back until tick() or updateLights() and replaced by newer frames.
+        Returns the number of messages sent."""
+        if not len(states) == 8:
+            raise Exception("Light frame has too few or too many pads: %s (must be 8)" % len(states))
+        program = self.programs[self.currentProgram if programNum is None else programNum]
+        self.pendingLights = (program, states)
+        return self.flushLights()
+
+    def flushLights(self) -> int:
+        if self.pendingLights is None:
+            return 0
+        now = time.monotonic()
+        if now < self.lastLightFrame + self.lightFrameInterval:
+            return 0
+        program, states = self.pendingLights
+        self.pendingLights = None
+        self.lastLightFrame = now
+
+        sent = 0
+        padLights = self.padLights
+        with self.dispatchLock:
+            for pad, on in zip(program.pads, states):
+                on = bool(on)
+                note = pad.note
+                if padLights.get(note) is not on:
+                    self.writeNote(note, on)
+                    padLights[note] = on
+                    sent += 1
+        return sent
+
+    def setLightPattern(self, pattern: "LPD8LightPattern"):
+        """Animate the pad lights of the active program with pattern (see lpd8lights), None stops the animation"""
+        self.lightPattern = pattern
+        self.lightPatternStart = time.monotonic()
+
+    def updateLights(self) -> int:
+        """Send the current frame of the light pattern and any frame held back, called by tick()"""
+        if self.lightPattern is not None and self.pendingLights is None:
+            if time.monotonic() >= self.lastLightFrame + self.lightFrameInterval:
+                self.pendingLights = (self.programs[self.currentProgram], self.lightPattern.frame(time.monotonic() - self.lightPatternStart))
+        return self.flushLights()
+
+    def bindCB(self, newCB: "LPD8Device.CB", CB: Callable[[int, int, int, int, int], None]):
+        """Attach CB to the binding matching newCB, creating the binding if there is none yet"""
+        cbs = self.programRoutes[newCB.program].setdefault(newCB.key, [])
+        for cb in cbs:
+            if type(cb) == type(newCB):
+                if CB not in cb.funcs:
+                    cb.funcs.append(CB)
+                return
+        newCB.funcs.append(CB)
+        cbs.append(newCB)
+        self.cbList.append(newCB)
+
+    def unbindCB(self, cbType: type, programNum: int, key: Tuple[str, int], CB: Callable[[int, int, int, int, int], None]):
+        """Detach CB from the binding of type cbType, dropping the binding once it has no functions left"""
+        routes = self.programRoutes[programNum]
+        cbs = routes.get(key)
+        if not cbs:
+            return
+        for cb in cbs:
+            if type(cb) == cbType:
+                if CB in cb.funcs:
+                    cb.funcs.remove(CB)
+                if not cb.funcs:
+                    cbs.remove(cb)
+                    self.cbList.remove(cb)
+                break
+        if not cbs:
+            del routes[key]
+
+    def controlNums(self, programNum: int, controlNum: int, name: str) -> Tuple[List[int], List[int]]:
+        """Programs and pads/knobs a binding applies to, None stands for all of them"""
+        if programNum is not None and not 0 <= programNum <= 3:
             raise Exception("Program index out of range: %s (must be 0-3)" % programNum)
-        if not 0 <= padNum <= 7:
-            raise("Pad out of range: %s (must be 0-7)" % padNum)
-
-        pad = self.programs[programNum].pads[padNum]
+        if controlNum is not None and not 0 <= controlNum <= 7:
+            raise Exception("%s out of range: %s (must be 0-7)" % (name, controlNum))
+        return (range(4) if programNum is None else [programNum]), (range(8) if controlNum is None else [controlNum])
 
-        if note:
-            for cb in self.cbList:
-                if type(cb) == LPD8Device.PadNoteCB and cb.note == pad.note:
-                    if CB not in cb.funcs:
-                        cb.funcs.append(CB)
-                    break
-            else:
-                newCB = LPD8Device.PadNoteCB(programNum, padNum, pad.note)
-                newCB.funcs.append(CB)
-                self.cbList.append(newCB)
-
-        if cc:
-            for cb in self.cbList:
-                if type(cb) == LPD8Device.PadCCCB and cb.cc == pad.controlChange:
-                    if CB not in cb.funcs:
-                        cb.funcs.append(CB)
-                    break
-            else:
-                newCB = LPD8Device.PadCCCB(programNum, padNum, pad.controlChange)
-                newCB.funcs.append(CB)
-                self.cbList.append(newCB)
-
-        if pc:
-            for cb in self.cbList:
-                if type(cb) == LPD8Device.PadPCCB and cb.pc == pad.programChange:
-                    if CB not in cb.funcs:
-                        cb.funcs.append(CB)
-                    break
-            else:
-                newCB = LPD8Device.PadPCCB(programNum, padNum, pad.programChange)
-                newCB.funcs.append(CB)
-                self.cbList.append(newCB)
+    def addPadCB(self, programNum: int, padNum: int, CB: Callable[[int, int, int, int, int], None], note: bool=True, cc: bool=False, pc: bool=False):
+        """Call CB for a pad of a program. programNum/padNum None binds all programs/pads, resolved right here."""
+        programNums, padNums = self.controlNums(programNum, padNum, "Pad")
+        for programNum in programNums:
+            for padNum in padNums:
+                pad = self.programs[programNum].pads[padNum]
+
+                if note:
+                    self.bindCB(LPD8Device.PadNoteCB(programNum, padNum, pad.note), CB)
+                if cc:
+                    self.bindCB(LPD8Device.PadCCCB(programNum, padNum, pad.controlChange), CB)
+                if pc:
+                    self.bindCB(LPD8Device.PadPCCB(programNum, padNum, pad.programChange), CB)
 
     def removePadCB(self, programNum: int, padNum: int, CB: Callable[[int, int, int, int, int], None], note: bool=True, cc: bool=False, pc: bool=False):
-        if not 0 <= programNum <= 3:
-            raise Exception("Program index out of range: %s (must be 0-3)" % programNum)
-        if not 0 <= padNum <= 7:
-            raise("Pad out of range: %s (must be 0-7)" % padNum)
-
-        pad = self.programs[programNum].pads[padNum]
-
-        if note:
-            for cb in self.cbList:
-                if type(cb) == LPD8Device.PadNoteCB and cb.note == pad.note:
-                    if CB in cb.funcs:
-                        cb.funcs.remove(CB)
-
-        if cc:
-            for cb in self.cbList:
-                if type(cb) == LPD8Device.PadCCCB and cb.cc == pad.controlChange:
-                    if CB in cb.funcs:
-                        cb.funcs.remove(CB)
-
-        if pc:
-            for cb in self.cbList:
-                if type(cb) == LPD8Device.PadPCCB and cb.pc == pad.programChange:
-                    if CB in cb.funcs:
-                        cb.funcs.remove(CB)
+        programNums, padNums = self.controlNums(programNum, padNum, "Pad")
+        for programNum in programNums:
+            for padNum in padNums:
+                pad = self.programs[programNum].pads[padNum]
+
+                if note:
+                    self.unbindCB(LPD8Device.PadNoteCB, programNum, ("note", pad.note), CB)
+                if cc:
+                    self.unbindCB(LPD8Device.PadCCCB, programNum, ("cc", pad.controlChange), CB)
+                if pc:
+                    self.unbindCB(LPD8Device.PadPCCB, programNum, ("pc", pad.programChange), CB)
 
     def addKnobCB(self, programNum: int, knobNum: int, CB: Callable[[int, int, int, int, int], None]):
-        if not 0 <= programNum <= 3:
-            raise Exception("Program index out of range: %s (must be 0-3)" % programNum)
-        if not 0 <= knobNum <= 7:
-            raise("Pad out of range: %s (must be 0-7)" % knobNum)
-
-        knob = self.programs[programNum].knobs[knobNum]
-        for cb in self.cbList:
-            if type(cb) == LPD8Device.KnobCCCB and cb.cc == knob.controlChange:
-                if CB not in cb.funcs:
-                    cb.funcs.append(CB)
-                    break
-            else:
-                newCB = LPD8Device.KnobCCCB(programNum, knobNum, knob.controlChange)
-                newCB.funcs.append(CB)
-                self.cbList.append(newCB)
+        """Call CB for a knob of a program. programNum/knobNum None binds all programs/knobs, resolved right here."""
+        programNums, knobNums = self.controlNums(programNum, knobNum, "Knob")
+        for programNum in programNums:
+            for knobNum in knobNums:
+                knob = self.programs[programNum].knobs[knobNum]
+                self.bindCB(LPD8Device.KnobCCCB(programNum, knobNum, knob.controlChange), CB)
 
     def removeKnobCB(self, programNum: int, knobNum: int, CB: Callable[[int, int, int, int, int], None]):
-        if not 0 <= programNum <= 3:
-            raise Exception("Program index out of range: %s (must be 0-3)" % programNum)
-        if not 0 <= knobNum <= 7:
-            raise("Pad out of range: %s (must be 0-7)" % knobNum)
-
-        knob = self.programs[programNum].knobs[knobNum]
-        for cb in self.cbList:
-            if type(cb) == LPD8Device.KnobCCCB and cb.cc == knob.controlChange:
-                if CB in cb.funcs:
-                    cb.funcs.remove(CB)
+        programNums, knobNums = self.controlNums(programNum, knobNum, "Knob")
+        for programNum in programNums:
+            for knobNum in knobNums:
+                knob = self.programs[programNum].knobs[knobNum]
+                self.unbindCB(LPD8Device.KnobCCCB, programNum, ("cc", knob.controlChange), CB)
 
-    def setPadToggle(self, programNum: int, padNum: int, toggle: bool=False):
+    def setPadToggle(self, programNum: int, padNum: int, toggle: bool=False) -> concurrent.futures.Future:
         if not 0 <= programNum <= 3:
             raise Exception("Program index out of range: %s (must be 0-3)" % programNum)
         if not 0 <= padNum <= 7:
-            raise("Pad out of range: %s (must be 0-7)" % padNum)
+            raise Exception("Pad out of range: %s (must be 0-7)" % padNum)
 
         program = self.programs[programNum]
         pad = program.pads[padNum]
         pad.toggle = toggle
-        self.writeSysex(program.writeProgram())
+        return self.queueProgramWrite(programNum)
 
     def setActiveProgram(self, programNum: int):
         if not 0 <= programNum <= 3:
@@ -411,27 +1311,105 @@ class LPD8Device():
     def writeNote(self, note: int, on: bool=True):
         raise NotImplementedError
 
-    def readMidi(self, waitForProgram: bool=False):
+    def readMidi(self, waitForProgram: bool=False, timeout: float=0.0):
+        """Process all pending midi messages.
+        If waitForProgram is True, block until a program was received or one second has passed.
+        Otherwise block for up to timeout seconds until at least one message has arrived."""
+        if waitForProgram:
+            timeout = max(timeout, 1.0)     # Wait one second for a program
+        deadline = time.monotonic() + timeout
+        receivedMessage = False
+        while 1:
+            try:
+                receivedAt, msg = self.inQueue.get_nowait()
+            except queue.Empty:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or (receivedMessage and not waitForProgram):
+                    return
+                try:
+                    receivedAt, msg = self.inQueue.get(timeout=remaining)
+                except queue.Empty:
+                    return
+            receivedMessage = True
+            if msg is None:     # Woken up by wakeLoop
+                continue
+
+            self.receiptTime = receivedAt
+            if self.handleMidi(msg) and waitForProgram:
+                return
+
+    def handleMidi(self, msg) -> bool:
+        """Decode a message of the backend: parse sysex, and once setup is complete trigger the callbacks of others.
+        Returns true if a program was received"""
         raise NotImplementedError
 
+    def queueMidi(self, msg):
+        """Hand a message over to readMidi, called by backends from their input thread"""
+        self.inQueue.put((time.perf_counter(), msg))
+        self.inputReady()
+
+    def inputReady(self):
+        """Called by backends whenever a new message is available to readMidi"""
+        if self.inputReadyCB is not None:
+            self.inputReadyCB()
+
+    def addSysexHandler(self, command: int, handler: Callable[[Tuple[int, ...]], bool]):
+        """Handle Akai sysex messages (starting with 0x47 0x7F 0x75) with the given command byte.
+        The handler is called with the raw sysex data and returns True if it received a program."""
+        self.sysexHandlers[command] = handler
+
+    def removeSysexHandler(self, command: int):
+        self.sysexHandlers.pop(command, None)
+
     def parseSysex(self, data: Tuple[int, ...]) -> bool:
         """Parse an incoming sysex message
         data is the raw sysex data without the start and stop bytes
         Returns true if a program was received"""
-        try:
-            # Try to parse message as lpd8-program
-            newProgram = LPD8Program()
-            newProgram.readProgram(list(data))
-            self.programs[newProgram.programIndex] = newProgram
-            return True
-        except:
-            pass
-
-        if data[:-1] == (0x47, 0x7F, 0x75, 0x64, 0x00, 0x01):
-            newprog = data[6] - 1   # return value is 1-indexed
-            if not newprog == self.currentProgram and callable(self.programChangeCB):
-                self.programChangeCB(newprog)
-            self.currentProgram = newprog
+        if self.instrumentation is not None:
+            self.instrumentation.count("sysexReceived")
+        if self.recorder is not None:
+            self.recorder.recordSysex(data)
+        if len(data) < 4 or data[0] != 0x47 or data[1] != 0x7F or data[2] != 0x75:
+            return False
+        handler = self.sysexHandlers.get(data[3])
+        if handler is None:
             return False
+        return handler(data)
 
+    def handleProgramSysex(self, data: Tuple[int, ...]) -> bool:
+        if len(data) < LPD8Program.length or data[4] != 0x00 or data[5] != 0x3A or not 1 <= data[6] <= 4:
+            return False
+        programNum = data[6] - 1
+        if programNum not in self.fetchMissing:     # Late duplicate or unrequested, the program may be solved already
+            return False
+        newProgram = LPD8Program()
+        newProgram.readProgram(data)
+        self.fetchMissing.remove(programNum)
+        self.fetchRequested.pop(programNum, None)
+        self.deviceProgramData[programNum] = bytes(data[6:LPD8Program.length])    # Raw, readProgram drops the channel
+        self.normalizeProgram(newProgram)
+        self.programs[programNum] = newProgram
+        return True
+
+    def handleActiveProgramSysex(self, data: Tuple[int, ...]) -> bool:
+        if len(data) != 7 or data[4] != 0x00 or data[5] != 0x01:
+            return False
+        self.lastProgramSeen = time.time()
+        self.programUncertain = False
+        self.updateCurrentProgram(data[6] - 1)  # return value is 1-indexed
         return False
+
+    def updateCurrentProgram(self, newprog: int):
+        if self.switchProgram(newprog) and callable(self.programChangeCB):
+            self.programChangeCB(newprog)
+
+    def switchProgram(self, newprog: int) -> bool:
+        """Route by newprog from now on, returns True if the program changed"""
+        with self.dispatchLock:
+            if newprog == self.currentProgram:
+                return False
+            self.cbIndex = self.programRoutes[newprog]
+            if self.sharedState is not None:
+                self.sharedState.setProgram(newprog)
+            self.currentProgram = newprog
+            return True
@@ -0,0 +1,182 @@
+from typing import AsyncIterator, Callable, Dict, List, Type
+
+from lpd8 import LPD8Device, LPD8Event
+from lpd8lights import LPD8LightPattern
+
+import asyncio
+import time
+
+class AsyncLPD8Device():
+    """asyncio frontend for any LPD8Device backend
+    Incoming midi is processed inside the event loop as soon as the backend reports it, so no tick() calls are needed.
+    Callbacks may be coroutine functions, they are scheduled as tasks on the loop."""
+    def __init__(self, device: LPD8Device, queryInterval: float=0.1):
+        self.device = device    # type: LPD8Device
+        self.queryInterval = queryInterval
+        self.programChangeCB = None
+        self.loop = None        # type: asyncio.AbstractEventLoop
+        self.inputEvent = None  # type: asyncio.Event
+        self.inputPending = False
+        self.queryHandle = None # type: asyncio.TimerHandle
+        self.lightsHandle = None    # type: asyncio.TimerHandle
+        self.wrappedCBs = {}    # type: Dict[Callable, Callable]
+
+    @classmethod
+    async def open(cls, deviceClass: Type[LPD8Device], queryInterval: float=0.1, timeout: float=None, **kwargs) -> "AsyncLPD8Device":
+        """Create a device of deviceClass and set it up without blocking the event loop"""
+        device = deviceClass(autoSetup=False, **kwargs)
+        asyncDevice = cls(device, queryInterval)
+        await asyncDevice.setup(timeout)
+        return asyncDevice
+
+    async def setup(self, timeout: float=None):
+        """Open the device and await all programs, timeout defaults to the device's programFetchTimeout"""
+        device = self.device
+        self.loop = asyncio.get_running_loop()
+        self.inputEvent = asyncio.Event()
+        device.inputReadyCB = self.inputReady
+        device.programChangeCB = self.programChanged
+
+        device.getDevice()
+        try:
+            if not device.loadCachedPrograms():
+                await self.readPrograms(timeout)
+
+            device.checkAmbiguity()
+            await self.flushWrites()
+            device.storeCachedPrograms()
+
+            device.completeSetup()
+        except BaseException:   # Also on cancellation
+            device.abortSetup()
+            raise
+        self.queryProgram()
+
+    async def flushWrites(self):
+        """Await until all queued program writes were sent"""
+        while not self.device.flushWrites():
+            await asyncio.sleep(max(0.0, self.device.nextWriteTime() - time.monotonic()))
+
+    def scheduleWrites(self):
+        """Flush queued program writes from the loop as soon as they are due"""
+        if not self.device.flushWrites():
+            self.loop.call_at(self.loop.time() + max(0.0, self.device.nextWriteTime() - time.monotonic()), self.scheduleWrites)
+
+    async def readPrograms(self, timeout: float=None):
+        """Await all programs, requested and retried like LPD8Device.getPrograms but without blocking the loop"""
+        device = self.device
+        device.startProgramFetch([0, 1, 2, 3], timeout)
+        while device.fetchMissing:
+            wait = device.requestPrograms()
+            self.inputEvent.clear()
+            try:
+                await asyncio.wait_for(self.inputEvent.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    def close(self):
+        """Stop processing input and querying the active program, and close the device"""
+        if self.queryHandle is not None:
+            self.queryHandle.cancel()
+            self.queryHandle = None
+        if self.lightsHandle is not None:
+            self.lightsHandle.cancel()
+            self.lightsHandle = None
+        self.device.inputReadyCB = None
+        self.device.close()
+
+    def inputReady(self):
+        """Runs in the backend's input thread, hands processing over to the loop"""
+        if not self.inputPending:
+            self.inputPending = True
+            self.loop.call_soon_threadsafe(self.processInput)
+
+    def processInput(self):
+        self.inputPending = False
+        self.device.readMidi()
+        self.flushCoalesced()
+        self.inputEvent.set()
+
+    def flushCoalesced(self):
+        device = self.device
+        device.flushCoalesced()
+        if device.coalescedValues:  # Quantum hasn't passed yet
+            delay = device.lastCoalesceFlush + device.coalesceQuantum - time.monotonic()
+            self.loop.call_later(max(0.0, delay), self.flushCoalesced)
+
+    def queryProgram(self):
+        if time.time() >= self.device.nextQueryTime(self.queryInterval):
+            self.device.queryActiveProgram()
+        self.scheduleWrites()
+        self.queryHandle = self.loop.call_later(self.queryInterval, self.queryProgram)
+
+    def programChanged(self, programNum: int):
+        if callable(self.programChangeCB):
+            self.schedule(self.programChangeCB(programNum))
+
+    def schedule(self, result):
+        if asyncio.iscoroutine(result):
+            self.loop.create_task(result)
+
+    def wrapCB(self, CB: Callable) -> Callable:
+        if not asyncio.iscoroutinefunction(CB):
+            return CB
+        if CB not in self.wrappedCBs:
+            self.wrappedCBs[CB] = lambda *args: self.schedule(CB(*args))
+        return self.wrappedCBs[CB]
+
+    def addPadCB(self, programNum: int, padNum: int, CB: Callable, note: bool=True, cc: bool=False, pc: bool=False):
+        self.device.addPadCB(programNum, padNum, self.wrapCB(CB), note, cc, pc)
+
+    def removePadCB(self, programNum: int, padNum: int, CB: Callable, note: bool=True, cc: bool=False, pc: bool=False):
+        self.device.removePadCB(programNum, padNum, self.wrappedCBs.get(CB, CB), note, cc, pc)
+
+    def addKnobCB(self, programNum: int, knobNum: int, CB: Callable):
+        self.device.addKnobCB(programNum, knobNum, self.wrapCB(CB))
+
+    def removeKnobCB(self, programNum: int, knobNum: int, CB: Callable):
+        self.device.removeKnobCB(programNum, knobNum, self.wrappedCBs.get(CB, CB))
+
+    def lightPad(self, pad: int, on: bool=True):
+        self.device.lightPad(pad, on)
+
+    def setActiveProgram(self, programNum: int):
+        self.device.setActiveProgram(programNum)
+
+    def setPadLights(self, states: List[bool], programNum: int=None):
+        self.device.setPadLights(states, programNum)
+        self.scheduleLights()
+
+    def setLightPattern(self, pattern: LPD8LightPattern):
+        self.device.setLightPattern(pattern)
+        self.scheduleLights()
+
+    def scheduleLights(self):
+        """Keep updating the pad lights from the loop while a pattern runs or a frame is held back"""
+        if self.lightsHandle is not None:
+            self.lightsHandle.cancel()
+            self.lightsHandle = None
+        device = self.device
+        device.updateLights()
+        if device.lightPattern is not None or device.pendingLights is not None:
+            delay = max(0.0, device.lastLightFrame + device.lightFrameInterval - time.monotonic())
+            self.lightsHandle = self.loop.call_later(delay, self.scheduleLights)
+
+    def setPadToggle(self, programNum: int, padNum: int, toggle: bool=False):
+        self.device.setPadToggle(programNum, padNum, toggle)
+        self.scheduleWrites()
+
+    async def events(self, maxsize: int=0) -> AsyncIterator[LPD8Event]:
+        """Yield every pad and knob event. If maxsize is set, events are dropped while the consumer lags behind."""
+        events = asyncio.Queue(maxsize)    # type: asyncio.Queue
+
+        def listener(event: LPD8Event):
+            if not events.full():
+                events.put_nowait(event)
+
+        self.device.addEventListener(listener)
+        try:
+            while True:
+                yield await events.get()
+        finally:
+            self.device.removeEventListener(listener)
@@ -0,0 +1,187 @@
+"""Benchmarks for python-lpd8, runs headless on the simulator backend and prints the results as JSON
+
+    python lpd8bench.py [--quick] [--output results.json]
+"""
+from typing import Callable, Dict, List
+
+from lpd8 import LPD8Program
+from lpd8sim import LPD8DeviceSim, VirtualLPD8
+
+import argparse
+import collections
+import json
+import platform
+import sys
+import time
+
+def timeit(func: Callable[[], None], duration: float) -> Dict[str, float]:
+    """Call func repeatedly for about duration seconds"""
+    calls = 0
+    start = time.perf_counter()
+    end = start + duration
+    while True:
+        for i in range(100):
+            func()
+        calls += 100
+        now = time.perf_counter()
+        if now >= end:
+            break
+    return {"calls": calls, "seconds": now - start, "callsPerSecond": calls / (now - start)}
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    samples = sorted(samples)
+    if not samples:
+        return {}
+    pick = lambda p: samples[min(len(samples) - 1, int(p * len(samples)))] * 1e6
+    return {"count": len(samples), "meanUs": sum(samples) / len(samples) * 1e6,
+            "p50Us": pick(0.5), "p90Us": pick(0.9), "p99Us": pick(0.99), "maxUs": samples[-1] * 1e6}
+
+def openDevice(**kwargs) -> LPD8DeviceSim:
+    return LPD8DeviceSim(virtual=VirtualLPD8(), **kwargs)
+
+def closeDevice(device: LPD8DeviceSim):
+    device.close()
+    device.virtual.remove()
+
+def benchDispatch(duration: float) -> Dict[str, dict]:
+    """triggerCallback throughput with a growing number of bindings"""
+    results = {}
+    device = openDevice()
+    callback = lambda programNum, padNum, knobNum, value, noteon, noteoff, cc, pc: None
+    messages = []   # Arguments of triggerCallback for every bound control
+    bindings = 0
+    for count in (1, 16, 64, 128):
+        while bindings < count:
+            programNum, control = divmod(bindings, 32)
+            kind, index = divmod(control, 8)
+            program = device.programs[programNum]
+            if kind == 0:
+                device.addPadCB(programNum, index, callback)
+                messages.append((program.pads[index].note, None, None, None, 100))
+            elif kind == 1:
+                device.addPadCB(programNum, index, callback, note=False, cc=True)
+                messages.append((None, None, program.pads[index].controlChange, None, 100))
+            elif kind == 2:
+                device.addPadCB(programNum, index, callback, note=False, pc=True)
+                messages.append((None, None, None, program.pads[index].programChange, None))
+            else:
+                device.addKnobCB(programNum, index, callback)
+                messages.append((None, None, program.knobs[index].controlChange, None, 64))
+            bindings += 1
+
+        cycle = messages * (max(1, 128 // len(messages)))
+        triggerCallback = device.triggerCallback
+
+        def run():
+            for msg in cycle:
+                triggerCallback(*msg)
+
+        result = timeit(run, duration)
+        result["callsPerSecond"] *= len(cycle)
+        result["calls"] *= len(cycle)
+        results[str(count)] = result
+    closeDevice(device)
+    return results
+
+def benchCodec(duration: float) -> Dict[str, float]:
+    """LPD8Program.readProgram/writeProgram round trips"""
+    program = VirtualLPD8.defaultPrograms()[1]
+    reply = bytearray(program.writeProgram())
+    reply[0:6] = LPD8Program.replyHeader
+    reply = bytes(reply)
+    target = LPD8Program()
+
+    def run():
+        target.readProgram(reply)
+        target.writeProgram()
+
+    return timeit(run, duration)
+
+def conflictingPrograms() -> List[LPD8Program]:
+    """Worst case for the ambiguity solver: every pad and knob of every program uses the same values"""
+    programs = []
+    for programNum in range(4):
+        program = LPD8Program()
+        program.programIndex = programNum
+        for pad in program.pads:
+            pad.note = 0
+            pad.programChange = 0
+            pad.controlChange = 0
+        for knob in program.knobs:
+            knob.controlChange = 0
+        programs.append(program)
+    return programs
+
+def benchAmbiguity(duration: float) -> Dict[str, float]:
+    """checkAmbiguity on worst-case conflicting programs"""
+    device = LPD8DeviceSim(virtual=VirtualLPD8(), solveAmbiguity=True, autoSetup=False)
+    device.getDevice()
+
+    def run():
+        device.programs = conflictingPrograms()
+        device.checkAmbiguity()
+        device.dirtyPrograms = {}   # Nothing is ever sent, writes don't need to pile up
+
+    result = timeit(run, duration)
+    closeDevice(device)
+    return result
+
+def benchLatency(count: int, rate: float) -> Dict[str, float]:
+    """Time from a message leaving the virtual device to its callback, while flooding knob changes through readMidi"""
+    device = openDevice()
+    virtual = device.virtual
+    sent = collections.deque()
+    latencies = []
+
+    receiveMidi = virtual.receiver
+    def receiver(msg: List[int]):
+        sent.append(time.perf_counter())
+        receiveMidi(msg)
+    virtual.receiver = receiver
+
+    def callback(programNum, padNum, knobNum, value, noteon, noteoff, cc, pc):
+        latencies.append(time.perf_counter() - sent.popleft())
+    device.addKnobCB(0, 0, callback)
+
+    start = time.perf_counter()
+    playback = virtual.play(virtual.knobSweep(0, count), rate)
+    while playback.is_alive() or sent:
+        device.tick(queryInterval=3600, timeout=0.01)
+    seconds = time.perf_counter() - start
+    closeDevice(device)
+
+    result = percentiles(latencies)
+    result["rate"] = rate
+    result["eventsPerSecond"] = count / seconds
+    return result
+
+def main(argv: List[str]=None):
+    parser = argparse.ArgumentParser(description="Benchmark python-lpd8 on the simulator backend")
+    parser.add_argument("--quick", action="store_true", help="shorter runs, for smoke testing")
+    parser.add_argument("--output", help="write JSON results to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    duration = 0.1 if args.quick else 1.0
+    count = 1000 if args.quick else 20000
+    results = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.time(),
+        "benchmarks": {
+            "dispatch": benchDispatch(duration),
+            "codec": benchCodec(duration),
+            "ambiguity": benchAmbiguity(duration),
+            "latency": benchLatency(count, rate=None),
+            "latencyPaced": benchLatency(count // 4, rate=5000),
+        },
+    }
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,61 @@
+from typing import Dict, List
+
+from lpd8 import LPD8Program
+
+import hashlib
+import json
+import os
+import threading
+
+class LPD8ProgramCache():
+    """On-disk cache of the programs last written to each device
+    Entries are keyed by the device's deviceId (its port name) and carry a hash of their content,
+    so corrupted or hand-edited entries are ignored."""
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def contentHash(programs: List[LPD8Program]) -> str:
+        sha = hashlib.sha1()
+        for program in programs:
+            sha.update(bytes(program.writeProgram()))
+        return sha.hexdigest()
+
+    def readFile(self) -> Dict[str, dict]:
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def load(self, deviceId: str) -> List[LPD8Program]:
+        """Return the cached programs of deviceId, or None if there is no valid entry"""
+        with self.lock:
+            entry = self.readFile().get(deviceId)
+        if not entry:
+            return None
+
+        try:
+            programs = []
+            for data in entry["programs"]:
+                data = bytes.fromhex(data)
+                program = LPD8Program()
+                # Entries are stored as program writes, readProgram expects the header of a program reply
+                program.readProgram([0x47, 0x7F, 0x75, 0x63, 0x00, 0x3A] + list(data[6:]))
+                programs.append(program)
+        except Exception:
+            return None
+        if len(programs) != 4 or self.contentHash(programs) != entry["hash"]:
+            return None
+        return programs
+
+    def store(self, deviceId: str, programs: List[LPD8Program]):
+        with self.lock:
+            entries = self.readFile()
+            entries[deviceId] = {"hash": self.contentHash(programs),
+                                 "programs": [bytes(program.writeProgram()).hex() for program in programs]}
+            tmpPath = self.path + ".tmp"
+            with open(tmpPath, "w") as f:
+                json.dump(entries, f)
+            os.replace(tmpPath, self.path)
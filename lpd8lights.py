@@ -0,0 +1,41 @@
+from typing import List, Sequence
+
+class LPD8LightPattern():
+    """Pad light animation, LPD8Device.setLightPattern asks it for a frame whenever the lights are updated"""
+    def frame(self, elapsed: float) -> List[bool]:
+        """Light state of all 8 pads, elapsed seconds after the pattern was started"""
+        raise NotImplementedError
+
+class LPD8Blink(LPD8LightPattern):
+    """Blink pads on and off, on for duty of every period"""
+    def __init__(self, pads: Sequence[int]=range(8), period: float=0.5, duty: float=0.5):
+        self.pads = set(pads)
+        self.period = period
+        self.duty = duty
+
+    def frame(self, elapsed: float) -> List[bool]:
+        on = (elapsed % self.period) < self.period * self.duty
+        return [on and pad in self.pads for pad in range(8)]
+
+class LPD8Chase(LPD8LightPattern):
+    """Run a group of width lit pads along pads, one step every step seconds. With bounce it runs back and forth."""
+    def __init__(self, pads: Sequence[int]=range(8), step: float=0.1, width: int=1, bounce: bool=False):
+        self.pads = list(pads)
+        self.step = step
+        self.width = width
+        self.bounce = bounce
+
+    def frame(self, elapsed: float) -> List[bool]:
+        position = int(elapsed / self.step)
+        if self.bounce and len(self.pads) > 1:
+            cycle = 2 * (len(self.pads) - 1)
+            position %= cycle
+            if position >= len(self.pads):
+                position = cycle - position
+        else:
+            position %= len(self.pads)
+
+        states = [False] * 8
+        for i in range(self.width):
+            states[self.pads[(position + i) % len(self.pads)]] = True
+        return states
@@ -0,0 +1,98 @@
+from typing import Callable, Dict, List, Type
+
+from lpd8 import LPD8Device, LPD8Event
+
+import concurrent.futures
+import queue
+import time
+
+class LPD8Manager():
+    """Drives many LPD8 devices from one loop
+    All free devices are set up concurrently. Afterwards one poll() call processes the input of all of them,
+    sleeping until any device has input. Events carry the deviceId of the device they came from."""
+    def __init__(self, deviceClass: Type[LPD8Device]=None, **deviceKwargs):
+        if deviceClass is None:
+            from lpd8mido import LPD8DeviceMido
+            deviceClass = LPD8DeviceMido
+        self.deviceClass = deviceClass
+        self.deviceKwargs = deviceKwargs
+        self.devices = {}   # type: Dict[str, LPD8Device]
+        self.readyQueue = queue.Queue()     # type: queue.Queue
+        self.eventListeners = []    # type: List[Callable[[LPD8Event], None]]
+        self.running = False
+
+    def open(self, portNames: List[str]=None) -> List[LPD8Device]:
+        """Set up the devices on portNames (all free LPD8 ports if None) concurrently and return them.
+        If any device fails, the others are closed again and the exception is raised."""
+        if portNames is None:
+            portNames = self.deviceClass.freePortNames()
+        if not portNames:
+            return []
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(portNames)) as executor:
+            futures = [executor.submit(self.openDevice, portName) for portName in portNames]
+        devices = []
+        error = None
+        for future in futures:
+            try:
+                devices.append(future.result())
+            except Exception as e:
+                error = error or e
+        if error is not None:   # Don't leave the devices that did open behind with their ports occupied
+            for device in devices:
+                device.close()
+            raise error
+
+        for device in devices:
+            self.devices[device.deviceId] = device
+            for listener in self.eventListeners:
+                device.addEventListener(listener)
+        return devices
+
+    def openDevice(self, portName: str) -> LPD8Device:
+        device = self.deviceClass(portName=portName, autoSetup=False, **self.deviceKwargs)
+        device.inputReadyCB = lambda: self.readyQueue.put(device)
+        device.setup()     # Releases the port again if it fails
+        return device
+
+    def close(self):
+        for device in self.devices.values():
+            device.close()
+        self.devices = {}
+
+    def addEventListener(self, listener: Callable[[LPD8Event], None]):
+        """Call listener with every event of every device, event.device tells them apart"""
+        if listener not in self.eventListeners:
+            self.eventListeners.append(listener)
+            for device in self.devices.values():
+                device.addEventListener(listener)
+
+    def removeEventListener(self, listener: Callable[[LPD8Event], None]):
+        if listener in self.eventListeners:
+            self.eventListeners.remove(listener)
+            for device in self.devices.values():
+                device.removeEventListener(listener)
+
+    def poll(self, timeout: float=0.1, queryInterval: float=0.1):
+        """Wait up to timeout seconds for input on any device, then process input and program queries of all devices"""
+        if self.devices:
+            nextQuery = min(device.nextQueryTime(queryInterval) for device in self.devices.values())
+            timeout = min(timeout, max(0.0, nextQuery - time.time()))
+        try:
+            self.readyQueue.get(timeout=timeout)
+            while True:     # Every message queues its device again, those are all handled below
+                self.readyQueue.get_nowait()
+        except queue.Empty:
+            pass
+
+        for device in self.devices.values():
+            device.tick(queryInterval)
+
+    def run(self, queryInterval: float=0.1):
+        """Poll all devices until stop() is called"""
+        self.running = True
+        while self.running:
+            self.poll(queryInterval, queryInterval)
+
+    def stop(self):
+        self.running = False
@@ -0,0 +1,60 @@
+from typing import Callable, Dict, List, Sequence, Tuple, Union
+
+import math
+
+class LPD8KnobMapping():
+    """Maps raw knob values to a user range through a lookup table
+    The knob's low..high range is spread over minimum..maximum following curve:
+    "linear", "log" (fine control at the top), "exp" (fine control at the bottom) or a function mapping 0..1 to 0..1.
+    steepness shapes the log and exp curves. table replaces all of this with 128 values, one for every raw value.
+    Tables are built once per knob range, see LPD8Device.setKnobMapping."""
+    def __init__(self, minimum: float=0.0, maximum: float=1.0, curve: Union[str, Callable[[float], float]]="linear",
+                 steepness: float=10.0, table: Sequence[float]=None):
+        if isinstance(curve, str) and curve not in ("linear", "log", "exp"):
+            raise Exception("Unknown knob curve: %s" % curve)
+        if table is not None and len(table) != 128:
+            raise Exception("Knob table has %s values (must be 128)" % len(table))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.curve = curve
+        self.steepness = steepness
+        self.table = list(table) if table is not None else None
+        self.tables = {}    # type: Dict[Tuple[int, int], List[float]]   # (low, high) -> table
+        self.arrays = {}    # type: Dict[Tuple[int, int], numpy.ndarray]   # (low, high) -> table as array, for mapArray
+
+    def shape(self, x: float) -> float:
+        if self.curve == "linear":
+            return x
+        elif self.curve == "log":
+            return math.log1p(self.steepness * x) / math.log1p(self.steepness)
+        elif self.curve == "exp":
+            return ((1 + self.steepness) ** x - 1) / self.steepness
+        return self.curve(x)
+
+    def buildTable(self, low: int=0, high: int=127) -> List[float]:
+        """Value for every raw value 0-127 of a knob sending low..high"""
+        if self.table is not None:
+            return self.table
+        table = self.tables.get((low, high))
+        if table is None:
+            span = max(1, high - low)
+            scale = self.maximum - self.minimum
+            table = [self.minimum + scale * self.shape(min(1.0, max(0.0, (raw - low) / span))) for raw in range(128)]
+            self.tables[(low, high)] = table
+        return table
+
+    def map(self, value: int, low: int=0, high: int=127) -> float:
+        return self.buildTable(low, high)[value]
+
+    def mapArray(self, values, low: int=0, high: int=127):
+        """Map a whole buffer of raw values (anything numpy accepts, e.g. bytes of a recording) at once, needs numpy"""
+        try:
+            import numpy
+        except ImportError:
+            raise Exception("mapArray needs numpy")
+        table = self.arrays.get((low, high))
+        if table is None:
+            table = self.arrays[(low, high)] = numpy.array(self.buildTable(low, high))
+        if isinstance(values, (bytes, bytearray, memoryview)):
+            values = numpy.frombuffer(values, dtype=numpy.uint8)
+        return table[numpy.clip(numpy.asarray(values, dtype=numpy.intp), 0, 127)]
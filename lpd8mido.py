@@ -2,47 +2,65 @@ from typing import List
 
 from lpd8 import LPD8Device
 
-import mido
-import time
+import threading
+
+mido = None  # Imported on first use, so importing this module stays cheap
+
+def importMido():
+    global mido
+    if mido is None:
+        import mido as module
+        mido = module
+    return mido
 
 class LPD8DeviceMido(LPD8Device):
+    portPrefix = "LPD8:LPD8"
     occupiedDevicenames = []
+    occupiedLock = threading.Lock()
+    portNamesCache = None   # type: List[str]
 
-    def getDevice(self):
-        portnames = mido.get_ioport_names()
+    def __init__(self, portName: str=None, **kwargs):
+        self.portName = portName    # type: str   # If None, the first free LPD8 port is used
+        super(LPD8DeviceMido, self).__init__(**kwargs)
 
-        # Filter for LPD8 devices that aren't yet occupied by class-instances
-        portnames = [x for x in portnames if x.startswith("LPD8:LPD8") and x not in type(self).occupiedDevicenames]
+    @classmethod
+    def enumeratePorts(cls) -> List[str]:
+        return importMido().get_ioport_names()
 
-        if portnames:
-            self.port = mido.open_ioport(portnames[0])
-        else:
-            raise Exception("No free LPD8 devices left")
+    def getDevice(self):
+        importMido()
+        self.claimPort()
+        try:    # Messages are handed over from mido's input thread, so readMidi can block instead of polling
+            self.port = mido.open_ioport(self.portName, callback=self.queueMidi)
+        except:
+            self.releasePort()
+            raise
+        self.deviceId = self.portName
+
+    def close(self):
+        """Close the port, so it can be opened by another instance"""
+        super(LPD8DeviceMido, self).close()
+        self.port.close()
+        self.releasePort()
 
     def writeSysex(self, data: List[int]):
         msg = mido.Message("sysex", data=data)
         self.port.send(msg)
 
-    def readMidi(self, waitForProgram: bool = False):
-        starttime = time.time()
-        timeout = float(waitForProgram)     # Wait one second if waitForProgram is True
-        receivedProgram = False
-        while 1:
-            for msg in self.port.iter_pending():
-                # print("RECV: %s" % msg)
-                if msg.type == "sysex":
-                    receivedProgram = self.parseSysex(msg.data)
-                if self.setupComplete:
-                    if msg.type == "note_on":
-                        self.triggerCallback(msg.note, None, None, None, msg.velocity)
-                    elif msg.type == "note_off":
-                        self.triggerCallback(None, msg.note, None, None, msg.velocity)
-                    elif msg.type == "control_change":
-                        self.triggerCallback(None, None, msg.control, None, msg.value)
-                    elif msg.type == "program_change":
-                        self.triggerCallback(None, None, None, msg.program, None)
-            if receivedProgram or time.time() > (starttime + timeout):
-                return
+    def handleMidi(self, msg: "mido.Message") -> bool:
+        # print("RECV: %s" % msg)
+        if msg.type == "sysex":
+            return self.parseSysex(msg.data)
+        if self.setupComplete:
+            if msg.type == "note_on":
+                self.triggerCallback(msg.note, None, None, None, msg.velocity)
+            elif msg.type == "note_off":
+                self.triggerCallback(None, msg.note, None, None, msg.velocity)
+            elif msg.type == "control_change":
+                self.triggerCallback(None, None, msg.control, None, msg.value)
+            elif msg.type == "program_change":
+                self.triggerCallback(None, None, None, msg.program, None)
+        return False
 
     def writeNote(self, note: int, on: bool = True):
         if on:
@@ -0,0 +1,230 @@
+from typing import List, Tuple, Union
+
+from lpd8 import LPD8Device, LPD8Event
+
+import select
+import socket
+import struct
+import threading
+import time
+
+# Compact datagram format: header with magic, sequence number and event count, then one record per event:
+# kind (see below), program, pad/knob index and value
+COMPACT_MAGIC = b"LPD8"
+COMPACT_HEADER = struct.Struct("<4sIH")
+COMPACT_EVENT = struct.Struct("<BBBf")
+KIND_PAD_ON = 1
+KIND_PAD_OFF = 2
+KIND_KNOB = 3
+KIND_PAD_PC = 4
+
+def oscString(value: str) -> bytes:
+    data = value.encode() + b"\0"
+    return data + b"\0" * (-len(data) % 4)
+
+def oscMessage(address: str, *args: Union[int, float]) -> bytes:
+    tags = ","
+    data = b""
+    for arg in args:
+        if isinstance(arg, float):
+            tags += "f"
+            data += struct.pack(">f", arg)
+        else:
+            tags += "i"
+            data += struct.pack(">i", arg)
+    return oscString(address) + oscString(tags) + data
+
+def oscBundle(messages: List[bytes]) -> bytes:
+    data = oscString("#bundle") + struct.pack(">Q", 1)   # Time tag 1 means immediately
+    for message in messages:
+        data += struct.pack(">i", len(message)) + message
+    return data
+
+def parseOSC(data: bytes) -> List[Tuple[str, List[Union[int, float]]]]:
+    """(address, arguments) of every message in an OSC packet, bundles are flattened"""
+    def readString(offset: int) -> Tuple[str, int]:
+        end = data.index(b"\0", offset)
+        return data[offset:end].decode(), end + 4 - (end - offset) % 4
+
+    if data.startswith(b"#bundle\0"):
+        messages = []
+        offset = 16
+        while offset + 4 <= len(data):
+            size = struct.unpack_from(">i", data, offset)[0]
+            messages += parseOSC(data[offset + 4:offset + 4 + size])
+            offset += 4 + size
+        return messages
+
+    address, offset = readString(0)
+    tags, offset = readString(offset)
+    args = []
+    for tag in tags[1:]:
+        if tag == "i":
+            args.append(struct.unpack_from(">i", data, offset)[0])
+        elif tag == "f":
+            args.append(struct.unpack_from(">f", data, offset)[0])
+        else:
+            raise Exception("Unsupported OSC argument type: %s" % tag)
+        offset += 4
+    return [(address, args)]
+
+class LPD8OSCBridge():
+    """Forwards the events of an LPD8Device to any number of UDP destinations and takes commands back
+    Events are collected and sent every flushInterval seconds, packed as OSC bundles or compact datagrams
+    (format "osc" or "compact"), each datagram at most maxDatagramSize bytes. OSC messages sent to the bridge's port
+    light pads (<prefix>/light pad on) and switch the active program (<prefix>/program program).
+    Call poll() from the loop that calls tick(), or start() to run it in its own thread."""
+    maxDatagramSize = 1400
+
+    def __init__(self, device: LPD8Device, destinations: List[Tuple[str, int]], format: str="osc",
+                 flushInterval: float=0.01, listenHost: str="127.0.0.1", listenPort: int=0, prefix: str="/lpd8"):
+        if format not in ("osc", "compact"):
+            raise Exception("Unknown bridge format: %s" % format)
+        self.device = device
+        self.destinations = list(destinations)
+        self.format = format
+        self.flushInterval = flushInterval
+        self.prefix = prefix
+        self.pending = []   # type: List[LPD8Event]
+        self.lock = threading.Lock()
+        self.lastFlush = 0.0
+        self.sequence = 0
+        self.sentDatagrams = 0
+        self.rejectedCommands = 0   # Commands the device refused, e.g. a pad out of range
+        self.thread = None  # type: threading.Thread
+        self.running = False
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind((listenHost, listenPort))
+        self.socket.setblocking(False)
+        self.port = self.socket.getsockname()[1]
+
+        device.addEventListener(self.onEvent)
+
+    def onEvent(self, event: LPD8Event):
+        with self.lock:
+            self.pending.append(event)
+
+    def encode(self, events: List[LPD8Event]) -> List[bytes]:
+        """Pack events into as few datagrams as possible"""
+        if self.format == "osc":
+            records = [self.oscEvent(event) for event in events]
+            overhead = 16   # Bundle header
+        else:
+            records = [self.compactEvent(event) for event in events]
+            overhead = COMPACT_HEADER.size
+
+        prefix = 4 if self.format == "osc" else 0     # Bundle elements carry their length
+        datagrams = []
+        batch = []
+        size = 0
+        for record in records:
+            if batch and size + len(record) + prefix + overhead > self.maxDatagramSize:
+                datagrams.append(self.packBatch(batch))
+                batch = []
+                size = 0
+            batch.append(record)
+            size += len(record) + prefix
+        if batch:
+            datagrams.append(self.packBatch(batch))
+        return datagrams
+
+    def packBatch(self, records: List[bytes]) -> bytes:
+        if self.format == "osc":
+            return oscBundle(records)
+        self.sequence = (self.sequence + 1) & 0xFFFFFFFF
+        return COMPACT_HEADER.pack(COMPACT_MAGIC, self.sequence, len(records)) + b"".join(records)
+
+    def oscEvent(self, event: LPD8Event) -> bytes:
+        if event.knob is not None:
+            return oscMessage(self.prefix + "/knob", event.program, event.knob, event.value)
+        elif event.noteon is not None or (event.cc is not None and event.value):
+            return oscMessage(self.prefix + "/pad/on", event.program, event.pad, event.value)
+        elif event.pc is not None:
+            return oscMessage(self.prefix + "/pad/pc", event.program, event.pad)
+        return oscMessage(self.prefix + "/pad/off", event.program, event.pad, event.value or 0)
+
+    def compactEvent(self, event: LPD8Event) -> bytes:
+        if event.knob is not None:
+            return COMPACT_EVENT.pack(KIND_KNOB, event.program, event.knob, event.value)
+        elif event.noteon is not None or (event.cc is not None and event.value):
+            return COMPACT_EVENT.pack(KIND_PAD_ON, event.program, event.pad, event.value)
+        elif event.pc is not None:
+            return COMPACT_EVENT.pack(KIND_PAD_PC, event.program, event.pad, 0)
+        return COMPACT_EVENT.pack(KIND_PAD_OFF, event.program, event.pad, event.value or 0)
+
+    def flush(self, force: bool=False) -> int:
+        """Send all collected events to every destination, at most every flushInterval unless forced.
+        Returns the number of events sent."""
+        now = time.monotonic()
+        if not force and now < self.lastFlush + self.flushInterval:
+            return 0
+        self.lastFlush = now
+        with self.lock:
+            events = self.pending
+            self.pending = []
+        if not events:
+            return 0
+        for datagram in self.encode(events):
+            for destination in self.destinations:
+                try:
+                    self.socket.sendto(datagram, destination)
+                    self.sentDatagrams += 1
+                except BlockingIOError:
+                    pass    # Drop rather than stall the controller, it's UDP anyway
+        return len(events)
+
+    def receive(self) -> int:
+        """Handle all commands waiting on the socket, returns their number"""
+        count = 0
+        while True:
+            try:
+                data, sender = self.socket.recvfrom(65536)
+            except (BlockingIOError, ConnectionResetError):
+                return count
+            try:
+                messages = parseOSC(data)
+            except Exception:
+                continue    # Not OSC, ignore
+            for address, args in messages:
+                try:
+                    if address == self.prefix + "/light" and len(args) == 2:
+                        self.device.lightPad(int(args[0]), bool(args[1]))
+                    elif address == self.prefix + "/program" and len(args) == 1:
+                        self.device.setActiveProgram(int(args[0]))
+                    else:
+                        continue
+                except Exception:
+                    self.rejectedCommands += 1  # A bad command from the network must not stop the bridge
+                    continue
+                count += 1
+
+    def poll(self, timeout: float=0.0):
+        """Wait up to timeout seconds for commands, handle them and flush events if due"""
+        if timeout > 0:
+            timeout = min(timeout, max(0.0, self.lastFlush + self.flushInterval - time.monotonic()))
+            select.select([self.socket], [], [], timeout)
+        self.receive()
+        self.flush()
+
+    def start(self):
+        """Flush and receive commands from a background thread. Commands then call the device from that thread."""
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while self.running:
+            self.poll(self.flushInterval)
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def close(self):
+        self.stop()
+        self.flush(force=True)
+        self.device.removeEventListener(self.onEvent)
+        self.socket.close()
@@ -0,0 +1,127 @@
+from typing import Iterator, List, Tuple, Union
+
+from lpd8 import LPD8Device, LPD8Program
+
+import mmap
+import struct
+import threading
+import time
+
+# File layout: magic, the four programs as program write messages, then one record per message.
+# Every record starts with a monotonic timestamp in nanoseconds since the start of the recording, the message kind,
+# its note/control/program number and its value. Sysex records store the data length in number/value instead
+# and are followed by the raw sysex data.
+MAGIC = b"LPD8REC1"
+RECORD = struct.Struct("<QBBB")
+KIND_NOTEON = 1
+KIND_NOTEOFF = 2
+KIND_CC = 3
+KIND_PC = 4
+KIND_SYSEX = 5
+
+class LPD8Recorder():
+    """Appends every message an LPD8Device reads to a compact binary log, see LPD8Device.startRecording"""
+    def __init__(self, path: str, programs: List[LPD8Program]):
+        self.path = path
+        self.file = open(path, "wb")
+        self.lock = threading.Lock()
+        self.file.write(MAGIC)
+        for program in programs:
+            self.file.write(program.writeProgram())
+        self.start = time.monotonic_ns()
+        self.count = 0
+
+    def recordControl(self, noteon: int, noteoff: int, cc: int, pc: int, value: int):
+        if noteon is not None:
+            kind, number = KIND_NOTEON, noteon
+        elif noteoff is not None:
+            kind, number = KIND_NOTEOFF, noteoff
+        elif cc is not None:
+            kind, number = KIND_CC, cc
+        elif pc is not None:
+            kind, number = KIND_PC, pc
+        else:
+            return
+        record = RECORD.pack(time.monotonic_ns() - self.start, kind, number, value or 0)
+        with self.lock:
+            self.file.write(record)
+            self.count += 1
+
+    def recordSysex(self, data: Union[bytes, Tuple[int, ...]]):
+        data = bytes(data)
+        record = RECORD.pack(time.monotonic_ns() - self.start, KIND_SYSEX, len(data) & 0xFF, len(data) >> 8)
+        with self.lock:
+            self.file.write(record)
+            self.file.write(data)
+            self.count += 1
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+class LPD8Replay():
+    """Reads a recording through mmap, so recordings of any length can be replayed without loading them"""
+    def __init__(self, path: str):
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[0:len(MAGIC)] != MAGIC:
+            self.close()
+            raise Exception("Not an LPD8 recording: %s" % path)
+        self.dataOffset = len(MAGIC) + 4 * LPD8Program.length
+
+    @property
+    def programs(self) -> List[LPD8Program]:
+        """The programs of the device at the start of the recording"""
+        programs = []
+        for i in range(4):
+            offset = len(MAGIC) + i * LPD8Program.length
+            program = LPD8Program()
+            # Programs are stored as program writes, readProgram expects the header of a program reply
+            program.readProgram(LPD8Program.replyHeader + self.map[offset + 6:offset + LPD8Program.length])
+            programs.append(program)
+        return programs
+
+    def messages(self) -> Iterator[Tuple[int, int, int, Union[int, bytes]]]:
+        """Yield (nanoseconds, kind, number, value) for every record, value is the data for sysex records"""
+        offset = self.dataOffset
+        end = len(self.map)
+        unpack = RECORD.unpack_from
+        size = RECORD.size
+        while offset + size <= end:
+            timestamp, kind, number, value = unpack(self.map, offset)
+            offset += size
+            if kind == KIND_SYSEX:
+                length = number | value << 8
+                yield timestamp, kind, 0, self.map[offset:offset + length]
+                offset += length
+            else:
+                yield timestamp, kind, number, value
+
+    def replay(self, device: LPD8Device, speed: float=1.0) -> int:
+        """Feed all recorded messages to device through triggerCallback/parseSysex.
+        speed 1.0 replays in real time, 2.0 twice as fast and None as fast as possible. Returns the number of messages."""
+        triggerCallback = device.triggerCallback
+        start = time.monotonic_ns()
+        count = 0
+        for timestamp, kind, number, value in self.messages():
+            if speed:
+                delay = (start + timestamp / speed - time.monotonic_ns()) / 1e9
+                if delay > 0:
+                    time.sleep(delay)
+            if kind == KIND_CC:
+                triggerCallback(None, None, number, None, value)
+            elif kind == KIND_NOTEON:
+                triggerCallback(number, None, None, None, value)
+            elif kind == KIND_NOTEOFF:
+                triggerCallback(None, number, None, None, value)
+            elif kind == KIND_PC:
+                triggerCallback(None, None, None, number, None)
+            elif kind == KIND_SYSEX:
+                device.parseSysex(value)
+            count += 1
+        device.flushCoalesced(force=True)
+        return count
+
+    def close(self):
+        self.map.close()
+        self.file.close()
@@ -0,0 +1,97 @@
+from typing import List, Tuple
+
+from lpd8 import LPD8Device
+
+import threading
+import time
+
+rtmidi = None  # Imported on first use, so importing this module stays cheap
+
+def importRtMidi():
+    global rtmidi
+    if rtmidi is None:
+        import rtmidi as module
+        rtmidi = module
+    return rtmidi
+
+class LPD8DeviceRtMidi(LPD8Device):
+    """LPD8Device backend on python-rtmidi's raw callback interface
+    Messages are handed over as the byte lists rtmidi delivers and decoded by status byte, no message objects are
+    created. With directDispatch, control messages are dispatched right from rtmidi's input thread instead of from
+    readMidi/tick, callbacks then run in that thread. Sysex messages are always handled by readMidi.
+    Routing and device state are changed under dispatchLock, so both threads can handle messages at once."""
+    occupiedDevicenames = []
+    occupiedLock = threading.Lock()
+    portNamesCache = None   # type: List[str]
+
+    def __init__(self, portName: str=None, directDispatch: bool=False, **kwargs):
+        self.portName = portName    # type: str   # If None, the first free LPD8 port is used
+        self.directDispatch = directDispatch
+        super(LPD8DeviceRtMidi, self).__init__(**kwargs)
+
+    @classmethod
+    def enumeratePorts(cls) -> List[str]:
+        """Names of all midi input ports"""
+        midiIn = importRtMidi().MidiIn()
+        try:
+            return midiIn.get_ports()
+        finally:
+            midiIn.delete()
+
+    def getDevice(self):
+        importRtMidi()
+        self.claimPort()
+        try:
+            self.midiIn = rtmidi.MidiIn()
+            self.midiOut = rtmidi.MidiOut()
+            self.midiIn.open_port(self.midiIn.get_ports().index(self.portName))
+            self.midiOut.open_port(self.midiOut.get_ports().index(self.portName))
+            self.midiIn.ignore_types(sysex=False)
+            self.midiIn.set_callback(self.receiveMidi)
+        except:
+            self.releasePort()
+            raise
+        self.deviceId = self.portName
+
+    def close(self):
+        """Close the ports, so they can be opened by another instance"""
+        super(LPD8DeviceRtMidi, self).close()
+        self.midiIn.cancel_callback()
+        self.midiIn.close_port()
+        self.midiOut.close_port()
+        self.releasePort()
+
+    def receiveMidi(self, event: Tuple[List[int], float], data=None):
+        """Port callback, runs in rtmidi's input thread"""
+        msg = event[0]
+        if self.directDispatch and msg[0] != 0xF0 and self.setupComplete:
+            self.dispatchMidi(msg, time.perf_counter())
+            return
+        self.queueMidi(msg)
+
+    def handleMidi(self, msg: List[int]) -> bool:
+        if msg[0] == 0xF0:
+            return self.parseSysex(msg[1:-1])
+        if self.setupComplete:
+            self.dispatchMidi(msg)
+        return False
+
+    def dispatchMidi(self, msg: List[int], receivedAt: float=None):
+        status = msg[0] & 0xF0
+        if status == 0xB0:
+            self.triggerCallback(None, None, msg[1], None, msg[2], receivedAt)
+        elif status == 0x90:
+            self.triggerCallback(msg[1], None, None, None, msg[2], receivedAt)
+        elif status == 0x80:
+            self.triggerCallback(None, msg[1], None, None, msg[2], receivedAt)
+        elif status == 0xC0:
+            self.triggerCallback(None, None, None, msg[1], None, receivedAt)
+
+    def writeSysex(self, data: List[int]):
+        self.midiOut.send_message([0xF0] + list(data) + [0xF7])
+
+    def writeNote(self, note: int, on: bool=True):
+        if on:
+            self.midiOut.send_message([0x96, note, 64])
+        else:
+            self.midiOut.send_message([0x86, note, 64])
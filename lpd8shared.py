@@ -0,0 +1,127 @@
+from typing import List, Tuple
+
+from multiprocessing import resource_tracker, shared_memory
+
+import struct
+import threading
+
+# Layout of the state block. The sequence counter works as a seqlock: it is odd while the block is being written,
+# readers retry until they read the same even sequence before and after copying the block.
+MAGIC = b"LPD8STA1"
+SEQUENCE = struct.Struct("<Q")
+SEQUENCE_OFFSET = 8
+PROGRAM_OFFSET = 16     # Active program
+KNOB_OFFSET = 20        # Raw value of every knob, 8 per program
+PAD_OFFSET = 52         # 1 while a pad is pressed (or toggled on), 8 per program
+VELOCITY_OFFSET = 84    # Velocity of the last press of every pad, 8 per program
+SIZE = 116
+
+createdNames = set()    # Segments created by this process
+
+class LPD8SharedState():
+    """Controller state block in shared memory, written by LPD8Device.shareState"""
+    def __init__(self, name: str=None):
+        self.memory = shared_memory.SharedMemory(name, create=True, size=SIZE)
+        self.name = self.memory.name
+        createdNames.add(self.name)
+        self.buf = self.memory.buf
+        self.buf[0:SIZE] = bytes(SIZE)
+        self.buf[0:len(MAGIC)] = MAGIC
+        self.sequence = 0
+        self.lock = threading.Lock()    # Messages may be handled by several threads, readers never lock
+
+    def update(self, offset: int, value: int, velocityOffset: int=None, velocity: int=0):
+        with self.lock:
+            buf = self.buf
+            self.sequence += 1
+            SEQUENCE.pack_into(buf, SEQUENCE_OFFSET, self.sequence)
+            buf[offset] = value
+            if velocityOffset is not None:
+                buf[velocityOffset] = velocity
+            self.sequence += 1
+            SEQUENCE.pack_into(buf, SEQUENCE_OFFSET, self.sequence)
+
+    def setKnob(self, programNum: int, knobNum: int, value: int):
+        self.update(KNOB_OFFSET + 8*programNum + knobNum, value & 0x7F)
+
+    def setPad(self, programNum: int, padNum: int, pressed: bool, velocity: int=0):
+        index = 8*programNum + padNum
+        if pressed:
+            self.update(PAD_OFFSET + index, 1, VELOCITY_OFFSET + index, velocity & 0x7F)
+        else:
+            self.update(PAD_OFFSET + index, 0)
+
+    def setProgram(self, programNum: int):
+        self.update(PROGRAM_OFFSET, programNum)
+
+    def close(self):
+        """Release and remove the segment, attached readers keep their mapping"""
+        self.buf = None
+        self.memory.close()
+        self.memory.unlink()
+        createdNames.discard(self.name)
+
+class LPD8StateSnapshot():
+    __slots__ = ("sequence", "program", "knobs", "pads", "velocities")
+
+    def __init__(self, sequence: int, program: int, knobs: List[List[int]], pads: List[List[bool]], velocities: List[List[int]]):
+        self.sequence = sequence
+        self.program = program
+        self.knobs = knobs              # knobs[program][knob]
+        self.pads = pads                # pads[program][pad]
+        self.velocities = velocities    # velocities[program][pad]
+
+class LPD8SharedStateReader():
+    """Attaches to the state block of another process by name and reads it without locking"""
+    def __init__(self, name: str):
+        try:
+            self.memory = shared_memory.SharedMemory(name, track=False)     # Python 3.13+: don't unlink on exit
+        except TypeError:
+            self.memory = shared_memory.SharedMemory(name)
+            # Older versions register every attached segment and unlink it when the reader exits, under the writer's feet
+            if name not in createdNames:
+                resource_tracker.unregister(self.memory._name, "shared_memory")
+        self.buf = self.memory.buf
+        if bytes(self.buf[0:len(MAGIC)]) != MAGIC:
+            self.close()
+            raise Exception("Not an LPD8 state block: %s" % name)
+
+    @property
+    def sequence(self) -> int:
+        """Changes whenever the state changes, cheap enough to poll"""
+        return SEQUENCE.unpack_from(self.buf, SEQUENCE_OFFSET)[0]
+
+    def readBlock(self) -> Tuple[int, bytes]:
+        """Consistent copy of the block and its sequence, retried while a write is in progress"""
+        buf = self.buf
+        while True:
+            before = SEQUENCE.unpack_from(buf, SEQUENCE_OFFSET)[0]
+            if before & 1:
+                continue
+            block = bytes(buf[PROGRAM_OFFSET:SIZE])
+            if SEQUENCE.unpack_from(buf, SEQUENCE_OFFSET)[0] == before:
+                return before, block
+
+    def read(self) -> LPD8StateSnapshot:
+        sequence, block = self.readBlock()
+
+        def rows(offset: int) -> List[List[int]]:
+            start = offset - PROGRAM_OFFSET
+            return [list(block[start + 8*i:start + 8*i + 8]) for i in range(4)]
+
+        pads = [[x == 1 for x in row] for row in rows(PAD_OFFSET)]
+        return LPD8StateSnapshot(sequence, block[0], rows(KNOB_OFFSET), pads, rows(VELOCITY_OFFSET))
+
+    def knob(self, programNum: int, knobNum: int) -> int:
+        """Single knob value straight from shared memory"""
+        return self.buf[KNOB_OFFSET + 8*programNum + knobNum]
+
+    def pad(self, programNum: int, padNum: int) -> bool:
+        return self.buf[PAD_OFFSET + 8*programNum + padNum] == 1
+
+    def program(self) -> int:
+        return self.buf[PROGRAM_OFFSET]
+
+    def close(self):
+        self.buf = None
+        self.memory.close()
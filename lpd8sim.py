@@ -0,0 +1,186 @@
+from typing import Dict, List
+
+from lpd8 import LPD8Device, LPD8Program
+
+import threading
+import time
+
+class VirtualLPD8():
+    """In-process model of an LPD8
+    Answers program requests and active program queries, stores written programs and emits pad/knob events.
+    Like the real device it ignores program writes that follow the previous write within writeInterval seconds.
+    Messages are raw midi bytes, sysex messages include the 0xF0 and 0xF7 framing bytes."""
+    devices = {}    # type: Dict[str, VirtualLPD8]   # All virtual devices by port name
+    created = 0
+    writeInterval = 0.3
+
+    def __init__(self, portName: str=None, programs: List[LPD8Program]=None):
+        if portName is None:
+            portName = "LPD8:LPD8 Virtual %s" % VirtualLPD8.created
+        VirtualLPD8.created += 1
+        self.portName = portName
+        self.programs = programs if programs is not None else VirtualLPD8.defaultPrograms()    # type: List[LPD8Program]
+        self.activeProgram = 0
+        self.lights = {}        # type: Dict[int, bool]   # Note -> pad light state
+        self.lastWrite = 0.0
+        self.acceptedWrites = 0
+        self.rejectedWrites = 0
+        self.receiver = None    # Called with every message the device emits
+        VirtualLPD8.devices[portName] = self
+
+    @staticmethod
+    def defaultPrograms() -> List[LPD8Program]:
+        """Four programs without ambiguities"""
+        programs = []
+        for programNum in range(4):
+            program = LPD8Program()
+            program.programIndex = programNum
+            for i in range(8):
+                program.pads[i].note = 36 + 8*programNum + i
+                program.pads[i].programChange = 8*programNum + i
+                program.pads[i].controlChange = 8*programNum + i
+                program.knobs[i].controlChange = 64 + 8*programNum + i
+                program.knobs[i].high = 127
+            programs.append(program)
+        return programs
+
+    def remove(self):
+        VirtualLPD8.devices.pop(self.portName, None)
+
+    def emit(self, msg: List[int]):
+        if self.receiver is not None:
+            self.receiver(msg)
+
+    def receive(self, msg: List[int]):
+        """Handle a message sent by the host"""
+        status = msg[0]
+        if status == 0xF0:
+            self.receiveSysex(msg[1:-1])
+        elif status & 0xF0 == 0x90:
+            self.lights[msg[1]] = True
+        elif status & 0xF0 == 0x80:
+            self.lights[msg[1]] = False
+
+    def receiveSysex(self, data: List[int]):
+        if len(data) < 6 or data[0] != 0x47 or data[1] != 0x7F or data[2] != 0x75:
+            return
+        command = data[3]
+        if command == 0x63 and len(data) == 7 and 1 <= data[6] <= 4:     # Program request
+            reply = bytearray(self.programs[data[6] - 1].writeProgram())
+            reply[0:6] = LPD8Program.replyHeader
+            self.emit([0xF0] + list(reply) + [0xF7])
+        elif command == 0x61 and len(data) == LPD8Program.length:       # Program write
+            now = time.monotonic()
+            if now < self.lastWrite + self.writeInterval:
+                self.rejectedWrites += 1
+                return
+            self.lastWrite = now
+            self.acceptedWrites += 1
+            program = LPD8Program()
+            program.readProgram(bytes(LPD8Program.replyHeader) + bytes(data[6:]))
+            self.programs[program.programIndex] = program
+        elif command == 0x64:   # Active program query
+            self.emit([0xF0, 0x47, 0x7F, 0x75, 0x64, 0x00, 0x01, self.activeProgram + 1, 0xF7])
+        elif command == 0x62 and len(data) == 8:    # Set active program
+            self.activeProgram = data[7]
+
+    def channel(self) -> int:
+        return self.programs[self.activeProgram].data[7] & 0x0F
+
+    def selectProgram(self, programNum: int):
+        """Switch the active program, as if done on the device"""
+        self.activeProgram = programNum
+
+    def pressPad(self, padNum: int, velocity: int=127, mode: str="note"):
+        """Emit what pressing a pad of the active program emits in the given mode ("note", "cc" or "pc")"""
+        pad = self.programs[self.activeProgram].pads[padNum]
+        if mode == "note":
+            self.emit([0x90 | self.channel(), pad.note, velocity])
+        elif mode == "cc":
+            self.emit([0xB0 | self.channel(), pad.controlChange, velocity])
+        elif mode == "pc":
+            self.emit([0xC0 | self.channel(), pad.programChange])
+
+    def releasePad(self, padNum: int, mode: str="note"):
+        pad = self.programs[self.activeProgram].pads[padNum]
+        if mode == "note":
+            self.emit([0x80 | self.channel(), pad.note, 127])
+        elif mode == "cc":
+            self.emit([0xB0 | self.channel(), pad.controlChange, 0])
+
+    def turnKnob(self, knobNum: int, value: int):
+        knob = self.programs[self.activeProgram].knobs[knobNum]
+        self.emit([0xB0 | self.channel(), knob.controlChange, value])
+
+    def play(self, messages: List[List[int]], rate: float=None) -> threading.Thread:
+        """Emit messages from a background thread, rate messages per second (as fast as possible if None)"""
+        def playback():
+            start = time.monotonic()
+            for i, msg in enumerate(messages):
+                if rate:
+                    delay = start + i / rate - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                self.emit(msg)
+
+        thread = threading.Thread(target=playback, daemon=True)
+        thread.start()
+        return thread
+
+    def knobSweep(self, knobNum: int, count: int=128) -> List[List[int]]:
+        """Messages of turning a knob of the active program back and forth count times"""
+        knob = self.programs[self.activeProgram].knobs[knobNum]
+        return [[0xB0 | self.channel(), knob.controlChange, abs(i % 254 - 127)] for i in range(count)]
+
+class LPD8DeviceSim(LPD8Device):
+    """LPD8Device backend talking to a VirtualLPD8 instead of hardware"""
+    portPrefix = ""
+    occupiedDevicenames = []
+    occupiedLock = threading.Lock()
+
+    def __init__(self, portName: str=None, virtual: VirtualLPD8=None, **kwargs):
+        self.portName = portName    # type: str
+        self.virtual = virtual      # type: VirtualLPD8   # If None, the virtual device on portName or a new one is used
+        super(LPD8DeviceSim, self).__init__(**kwargs)
+
+    @classmethod
+    def portNames(cls, refresh: bool=False) -> List[str]:
+        """Virtual devices come and go within the process, so they are never cached"""
+        return list(VirtualLPD8.devices)
+
+    def getDevice(self):
+        if self.virtual is None and self.portName is None:
+            self.virtual = VirtualLPD8()
+        if self.virtual is not None:
+            self.portName = self.virtual.portName
+        self.claimPort()
+        if self.virtual is None:
+            self.virtual = VirtualLPD8.devices[self.portName]
+        self.deviceId = self.portName
+        self.virtual.receiver = self.queueMidi
+
+    def close(self):
+        super(LPD8DeviceSim, self).close()
+        self.virtual.receiver = None
+        self.releasePort()
+
+    def writeSysex(self, data: List[int]):
+        self.virtual.receive([0xF0] + list(data) + [0xF7])
+
+    def writeNote(self, note: int, on: bool=True):
+        self.virtual.receive([(0x90 if on else 0x80) | 6, note, 127 if on else 0])
+
+    def handleMidi(self, msg: List[int]) -> bool:
+        status = msg[0] & 0xF0
+        if msg[0] == 0xF0:
+            return self.parseSysex(msg[1:-1])
+        if self.setupComplete:
+            if status == 0x90:
+                self.triggerCallback(msg[1], None, None, None, msg[2])
+            elif status == 0x80:
+                self.triggerCallback(None, msg[1], None, None, msg[2])
+            elif status == 0xB0:
+                self.triggerCallback(None, None, msg[1], None, msg[2])
+            elif status == 0xC0:
+                self.triggerCallback(None, None, None, msg[1], None)
+        return False
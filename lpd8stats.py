@@ -0,0 +1,78 @@
+from typing import Callable, Dict
+
+import threading
+
+class LPD8Histogram():
+    """Latency histogram with power-of-two microsecond buckets"""
+    bucketCount = 32
+
+    def __init__(self):
+        self.buckets = [0] * LPD8Histogram.bucketCount    # Bucket i counts samples below 2**i microseconds
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds: float):
+        us = int(seconds * 1e6)
+        self.buckets[min(us.bit_length(), LPD8Histogram.bucketCount - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, fraction: float) -> float:
+        """Upper bound of the bucket holding the given fraction of samples, in microseconds"""
+        target = fraction * self.count
+        seen = 0
+        for i, bucketCount in enumerate(self.buckets):
+            seen += bucketCount
+            if bucketCount and seen >= target:
+                return float(2 ** i)
+        return 0.0
+
+    def snapshot(self) -> Dict[str, object]:
+        return {"count": self.count,
+                "meanUs": self.total / self.count * 1e6 if self.count else 0.0,
+                "maxUs": self.max * 1e6,
+                "p50Us": self.percentile(0.5),
+                "p99Us": self.percentile(0.99),
+                "buckets": {"<%sus" % 2**i: x for i, x in enumerate(self.buckets) if x}}
+
+class LPD8Instrumentation():
+    """Latency histograms and counters of an LPD8Device
+    Histograms are kept per event kind ("note", "cc", "pc") for the time from receipt to dispatch and from dispatch to
+    the completion of all callbacks, and per callback function for its run time.
+    If sampleHook is set, it is called with (metric, key, seconds) for every sample, e.g. to feed an external collector."""
+    def __init__(self, sampleHook: Callable[[str, str, float], None]=None):
+        self.sampleHook = sampleHook
+        self.lock = threading.Lock()
+        self.histograms = {}    # type: Dict[str, Dict[str, LPD8Histogram]]
+        self.counters = {}      # type: Dict[str, int]
+
+    def record(self, metric: str, key: str, seconds: float):
+        with self.lock:
+            histograms = self.histograms.get(metric)
+            if histograms is None:
+                histograms = self.histograms[metric] = {}
+            histogram = histograms.get(key)
+            if histogram is None:
+                histogram = histograms[key] = LPD8Histogram()
+            histogram.record(seconds)
+        if self.sampleHook is not None:
+            self.sampleHook(metric, key, seconds)
+
+    def count(self, counter: str, amount: int=1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def stats(self) -> Dict[str, object]:
+        with self.lock:
+            stats = {metric: {key: histogram.snapshot() for key, histogram in histograms.items()}
+                     for metric, histograms in self.histograms.items()}
+            stats["counters"] = dict(self.counters)
+        return stats
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+            self.counters = {}